@@ -1,8 +1,11 @@
 import os
-import requests
+import sys
 import time
 import json
 from dotenv import load_dotenv
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import llm_client
+import embedding_cache
 from supabase_client import supabase
 
 # Load env vars
@@ -43,10 +46,17 @@ def preprocess_claim_row(row):
 # ✅ Embedding with retry logic
 def get_embedding_with_retry(payload, max_retries=5):
     delay = 3
+    text = embedding_cache.payload_text(payload)
+    cached = embedding_cache.lookup(text)
+    if cached is not None:
+        return cached
+
     for attempt in range(max_retries):
-        response = requests.post(endpoint, headers=headers, json=payload)
+        response = llm_client.post(endpoint, headers=headers, json=payload)
         if response.status_code == 200:
-            return response.json()["data"][0]["embedding"]
+            embedding = response.json()["data"][0]["embedding"]
+            embedding_cache.store(text, embedding)
+            return embedding
         elif response.status_code == 429:
             wait_time = delay * (2 ** attempt)
             print(f"⚠️ Rate limit hit. Retrying in {wait_time}s...")
@@ -0,0 +1,141 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+import numpy as np
+from dotenv import load_dotenv
+from lexical_index import tokenize, is_identifier
+
+load_dotenv()
+
+# === Semantic answer cache ===
+# Final answers to info questions, per user and role scope. An entry holds the normalised
+# embedding of the question, the answer and the version of every table the answer was built
+# from (the tables in the generated SQL plus the table_join of the retrieved vector_store rows).
+# A new question whose embedding is within ANSWER_CACHE_THRESHOLD cosine of a cached one, and
+# which names exactly the same numbers and identifiers ("last 3 orders" is not "last 5
+# orders", 100/35R24 is not 100/35R25), gets the cached answer, unless one of those tables
+# changed since: index_listener (for every vector_store change the writers publish) and
+# place_order bump table versions. Versions live in this process; workers running with
+# ENABLE_DB_LISTENERS=false rely on ANSWER_CACHE_TTL.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.96"))   # cosine similarity
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))               # seconds
+ANSWER_CACHE_PER_USER = int(os.getenv("ANSWER_CACHE_PER_USER", "50"))        # answers kept per scope
+
+KNOWN_TABLES = ("users", "dealer", "claim", "product", "warehouse", "sales_reps", "inventory", "orders")
+SQL_TABLE_PATTERN = re.compile(r"\b(?:from|join)\s+([a-z_][a-z0-9_]*)", re.IGNORECASE)
+
+# Messages that ask for an action rather than information are never answered from the cache
+ORDER_REQUEST_PATTERN = re.compile(
+    r"\b(place|buy|purchase|book|need|want|request|send|ship)\b|\border\s+\d+|\b\d+\s*(units?|pcs|pieces|tyres?|tires?)\b",
+    re.IGNORECASE)
+
+# get_llm_final_response / stream_llm_final_response fallback when the chat call fails
+FAILED_ANSWER_PREFIX = "Sorry, I can't assist with that."
+
+NUMBER_WORDS = {"one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+                "eleven", "twelve", "fifteen", "twenty", "fifty", "hundred"}
+
+_versions = {}            # table -> version, bumped on data change notifications
+_entries = {}             # scope -> deque of entries, oldest first
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "stale": 0, "stores": 0}
+
+
+def bump(*tables):
+    """Mark tables as changed; cached answers built from them are no longer served"""
+    with _lock:
+        for table in tables:
+            _versions[table] = _versions.get(table, 0) + 1
+    print(f"DEBUG: Answer cache data version bumped for {', '.join(tables)}")
+
+
+def tables_from_sql(sql):
+    """Known tables named in the FROM / JOIN clauses of a query"""
+    if not sql:
+        return set()
+    return {name.lower() for name in SQL_TABLE_PATTERN.findall(sql) if name.lower() in KNOWN_TABLES}
+
+
+def tables_from_rows(rows):
+    """Tables behind retrieved vector_store rows, from their table_join ("orders+product+dealer")"""
+    tables = set()
+    for row in rows or []:
+        for name in str(row.get("table_join") or "").split("+"):
+            if name.strip() in KNOWN_TABLES:
+                tables.add(name.strip())
+    return tables
+
+
+def is_cacheable_query(user_query):
+    return ANSWER_CACHE_ENABLED and not ORDER_REQUEST_PATTERN.search(user_query or "")
+
+
+def key_terms(user_query):
+    """Numbers and identifiers in a question; a cached answer is only reused for the same set"""
+    return frozenset(term for term in tokenize(user_query)
+                     if is_identifier(term) or term.isdigit() or term in NUMBER_WORDS)
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def lookup(scope, embedding, user_query):
+    """Cached answer for a question close to this one with the same key terms, or None"""
+    query = _unit(embedding)
+    if query is None:
+        return None
+    terms = key_terms(user_query)
+    now = time.time()
+    with _lock:
+        entries = _entries.get(scope)
+        if entries:
+            # Drop expired answers and answers whose tables changed
+            fresh = [entry for entry in entries if entry["expires_at"] >= now and all(
+                _versions.get(table, 0) == version for table, version in entry["versions"].items())]
+            if len(fresh) < len(entries):
+                _counters["stale"] += len(entries) - len(fresh)
+                entries = deque(fresh, maxlen=ANSWER_CACHE_PER_USER)
+                _entries[scope] = entries
+        candidates = [entry for entry in entries or () if entry["terms"] == terms]
+        if candidates:
+            similarities = np.stack([entry["embedding"] for entry in candidates]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= ANSWER_CACHE_THRESHOLD:
+                _counters["hits"] += 1
+                print(f"DEBUG: Answer cache hit (similarity {similarities[best]:.3f})")
+                return candidates[best]["answer"]
+        _counters["misses"] += 1
+    return None
+
+
+def store(scope, embedding, answer, tables, user_query):
+    vector = _unit(embedding)
+    if vector is None or not answer or answer.startswith(FAILED_ANSWER_PREFIX):
+        return
+    with _lock:
+        entries = _entries.setdefault(scope, deque(maxlen=ANSWER_CACHE_PER_USER))
+        entries.append({
+            "embedding": vector,
+            "answer": answer,
+            "terms": key_terms(user_query),
+            "versions": {table: _versions.get(table, 0) for table in tables},
+            "expires_at": time.time() + ANSWER_CACHE_TTL,
+        })
+        _counters["stores"] += 1
+
+
+def stats():
+    with _lock:
+        stats = dict(_counters)
+        stats["scopes"] = len(_entries)
+        stats["entries"] = sum(len(entries) for entries in _entries.values())
+        stats["versions"] = dict(_versions)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    return stats
@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Per-user conversation history ===
+# get_llm_sql, enhance_query_with_context and get_conversation_context all need the user's
+# latest exchanges. Instead of each reading conversation_logs, a bounded deque per user is
+# loaded once (newest HISTORY_SIZE rows) and then appended to by save_to_supabase, so one
+# request makes at most one PostgREST round trip and every consumer sees the same history.
+# Other workers write to conversation_logs too, so a user's buffer is re-read once it is
+# older than HISTORY_REFRESH seconds.
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "5"))               # exchanges kept per user
+HISTORY_REFRESH = float(os.getenv("HISTORY_REFRESH", "300"))     # seconds before re-reading conversation_logs
+HISTORY_MAX_USERS = int(os.getenv("HISTORY_MAX_USERS", "1000"))
+
+_histories = {}   # user_id -> {"exchanges": deque, "loaded_at": float, "lock": Lock}
+_lock = threading.Lock()
+
+
+def _history(user_id):
+    with _lock:
+        history = _histories.get(user_id)
+        if history is None:
+            if len(_histories) >= HISTORY_MAX_USERS:
+                # Forget the least recently loaded user
+                oldest = min(_histories, key=lambda key: _histories[key]["loaded_at"])
+                del _histories[oldest]
+            history = {"exchanges": deque(maxlen=HISTORY_SIZE), "loaded_at": 0.0, "lock": threading.Lock()}
+            _histories[user_id] = history
+        return history
+
+
+def _load(client, user_id, history):
+    result = client.table("conversation_logs") \
+        .select("user_query, ai_response") \
+        .eq("user_id", user_id) \
+        .order("query_timestamp", desc=True) \
+        .limit(HISTORY_SIZE) \
+        .execute()
+    rows = result.data if hasattr(result, 'data') else []
+    history["exchanges"] = deque(
+        ({"user_query": row["user_query"], "ai_response": row["ai_response"]} for row in reversed(rows or [])),
+        maxlen=HISTORY_SIZE)
+    history["loaded_at"] = time.time()
+
+
+def recent_exchanges(client, user_id, num_exchanges):
+    """The user's last num_exchanges exchanges, oldest first ({"user_query", "ai_response"} dicts)"""
+    history = _history(user_id)
+    # Concurrent consumers of one request wait for a single load
+    with history["lock"]:
+        if time.time() - history["loaded_at"] > HISTORY_REFRESH:
+            try:
+                _load(client, user_id, history)
+            except Exception as e:
+                print("DEBUG: Failed to fetch conversation history from Supabase:", e)
+                return []
+        exchanges = list(history["exchanges"])
+    if num_exchanges > HISTORY_SIZE:
+        print(f"DEBUG: {num_exchanges} exchanges requested, history keeps {HISTORY_SIZE}")
+    return exchanges[-num_exchanges:] if num_exchanges > 0 else []
+
+
+def append(user_id, user_query, ai_response):
+    """Record an exchange that was just written to conversation_logs"""
+    history = _history(user_id)
+    with history["lock"]:
+        # A buffer that was never loaded stays unloaded; the next read fetches it whole
+        if history["loaded_at"]:
+            history["exchanges"].append({"user_query": user_query, "ai_response": ai_response})
+
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Content-addressed embedding cache ===
+# Embeddings depend only on the model and the exact input text, so they never go stale.
+# Key: sha256(model + text). Two tiers:
+#   memory - per-process LRU of float32 vectors (hits cost microseconds, no quota)
+#   disk   - SQLite file of float32 bytes, shared by the API workers, the pg_notify
+#            listeners and the Embedding-DB ingestion scripts on the same host
+# EMBEDDING_CACHE_MODEL identifies the model/deployment; it defaults to the embedding URL
+# (which names the deployment), so switching deployments starts a fresh key space.
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))   # vectors kept in memory
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_cache.sqlite"))
+EMBEDDING_CACHE_MODEL = os.getenv("EMBEDDING_CACHE_MODEL") or os.getenv("AZURE_EMBEDDING_URL") or "default"
+
+
+def embedding_key(text, model=None):
+    digest = hashlib.sha256()
+    digest.update((model or EMBEDDING_CACHE_MODEL).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(str(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def payload_text(payload):
+    """The single input text of an embeddings payload ({"input": text} or {"input": [text]}), else None"""
+    value = payload.get("input") if isinstance(payload, dict) else None
+    if isinstance(value, list):
+        value = value[0] if len(value) == 1 else None
+    return value if isinstance(value, str) else None
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()   # key -> float32 vector, least recently used first
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self.path = path or None
+        self._local = threading.local()
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                                 "(key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL)")
+            except Exception as e:
+                print(f"DEBUG: Embedding cache disk tier unavailable ({e}), using memory only")
+                self.path = None
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _remember(self, key, vector):
+        with self.lock:
+            self.entries[key] = vector
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, text, model=None):
+        """Cached float32 vector for the text, or None"""
+        key = embedding_key(text, model)
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return vector
+        if self.path:
+            try:
+                row = self._connect().execute(
+                    "SELECT dim, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            except Exception as e:
+                print(f"DEBUG: Embedding cache disk read failed: {e}")
+                row = None
+            if row is not None:
+                vector = np.frombuffer(row[1], dtype=np.float32)
+                if vector.size == row[0]:
+                    self._remember(key, vector)
+                    self._count("disk_hits")
+                    return vector
+        self._count("misses")
+        return None
+
+    def set(self, text, embedding, model=None):
+        key = embedding_key(text, model)
+        vector = np.array(embedding, dtype=np.float32).ravel()
+        vector.flags.writeable = False   # shared between callers
+        self._remember(key, vector)
+        self._count("stores")
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    conn.execute("INSERT OR REPLACE INTO embeddings (key, dim, vector) VALUES (?, ?, ?)",
+                                 (key, int(vector.size), vector.tobytes()))
+            except Exception as e:
+                print(f"DEBUG: Embedding cache disk write failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        stats["disk"] = self.path
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+
+def lookup(text, model=None):
+    """Cached embedding as a list of floats (what the embeddings API returns), or None"""
+    if not EMBEDDING_CACHE_ENABLED or text is None:
+        return None
+    vector = get_embedding_cache().get(text, model)
+    return None if vector is None else vector.tolist()
+
+
+def store(text, embedding, model=None):
+    if EMBEDDING_CACHE_ENABLED and text is not None:
+        get_embedding_cache().set(text, embedding, model)
+
+
+def stats():
+    return get_embedding_cache().stats()
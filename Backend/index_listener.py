@@ -0,0 +1,96 @@
+import os
+import json
+import ssl
+import asyncio
+import asyncpg
+from dotenv import load_dotenv
+from supabase_client import supabase
+import answer_cache
+from vector_index import apply_vector_store_upsert, apply_vector_store_delete, SCORING_COLUMNS
+
+load_dotenv()
+
+# === vector_store change feed for the in-process index ===
+# Exactly one process turns order / inventory notifications into embeddings and
+# vector_store writes: the standalone listeners (python vector_trigger.py,
+# python inventory_trigger.py). After each write they publish the row id on
+# VECTOR_STORE_CHANNEL. API workers (unless ENABLE_DB_LISTENERS=false) run
+# listen_to_vector_store_changes, which only re-reads that row by id and mirrors it
+# into the local index, so any number of workers can listen without duplicate
+# embedding calls or vector_store rows. The workers also own the answer caches, so this is
+# where the tables behind a change (its table_join) get their answer_cache version bumped.
+VECTOR_STORE_CHANNEL = "vector_store_channel"
+RECONNECT_DELAY = 30   # seconds between connection attempts
+
+
+async def notify_vector_store_change(conn, row_id, table_join, op="upsert"):
+    """Publish a vector_store write (called by the writer on its asyncpg connection)"""
+    await conn.execute("SELECT pg_notify($1, $2)", VECTOR_STORE_CHANNEL,
+                       json.dumps({"id": row_id, "table_join": table_join, "op": op}))
+
+
+def fetch_vector_store_row(row_id):
+    response = supabase.table("vector_store").select(SCORING_COLUMNS).eq("id", row_id).execute()
+    rows = response.data or []
+    return rows[0] if rows else None
+
+
+async def handle_vector_store_change(conn, pid, channel, payload):
+    try:
+        change = json.loads(payload)
+        row_id = change["id"]
+        # The source data changed (a new order, a new stock level): drop answers built on it
+        tables = answer_cache.tables_from_rows([change])
+        if tables:
+            answer_cache.bump(*tables)
+        if change.get("op") == "delete":
+            apply_vector_store_delete(row_id)
+            return
+        row = await asyncio.to_thread(fetch_vector_store_row, row_id)
+        if row is None:
+            # Deleted again before we read it
+            apply_vector_store_delete(row_id)
+        else:
+            apply_vector_store_upsert(row)
+    except Exception as e:
+        print(f"DEBUG: Could not mirror vector_store change {payload}: {e}")
+
+
+async def listen_to_vector_store_changes():
+    """
+    Runs for the life of the process. In-place vector_store updates (inventory quantities)
+    only reach the index through here, so a lost connection is re-established.
+    """
+    if not os.getenv("SUPABASE_DB_HOST"):
+        print("DEBUG: SUPABASE_DB_HOST is not set; vector_store changes will not be mirrored into the index")
+        return
+    print(f"🔔 Starting listener for {VECTOR_STORE_CHANNEL}...")
+
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(
+                user=os.getenv("SUPABASE_DB_USER"),
+                password=os.getenv("SUPABASE_DB_PASSWORD"),
+                database=os.getenv("SUPABASE_DB_NAME"),
+                host=os.getenv("SUPABASE_DB_HOST"),
+                port=int(os.getenv("SUPABASE_DB_PORT", 5432)),
+                ssl=ssl_context
+            )
+            await conn.add_listener(VECTOR_STORE_CHANNEL, handle_vector_store_change)
+            print("✅ Mirroring vector_store changes into the vector index...")
+            while not conn.is_closed():
+                await asyncio.sleep(5)
+            print("DEBUG: vector_store listener connection closed, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"DEBUG: vector_store listener failed: {e}; retrying in {RECONNECT_DELAY}s")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(RECONNECT_DELAY)
@@ -0,0 +1,284 @@
+import os
+import re
+import json
+import math
+import random
+import threading
+from collections import Counter, namedtuple
+from dotenv import load_dotenv
+from lexical_index import tokenize
+
+load_dotenv()
+
+# === Local order / info intent classifier ===
+# Dealer and sales-rep messages need an intent before anything else happens, and most are
+# plainly informational. Keyword rules decide the obvious cases, a naive Bayes model trained
+# on logged conversation_logs queries (labelled offline by extract_order_details) decides
+# the rest when it is confident, and the ambiguous band waits for the planner's intent.
+# A local "info" decision lets SQL generation start alongside the planner instead of after
+# it; retrieval still waits for the plan's rewrite and metadata filter.
+#
+#   python intent_classifier.py train [--limit N]   label logged queries, fit, report precision
+#   python intent_classifier.py report              precision of the saved model on its holdout
+#
+# At runtime every local decision is also checked against the LLM intent whenever the
+# planner runs anyway; stats() reports that running precision per source.
+INTENT_MODEL_PATH = os.getenv(
+    "INTENT_MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_model.json"))
+INTENT_CONFIDENCE = float(os.getenv("INTENT_CONFIDENCE", "0.9"))   # model probability needed to decide locally
+INTENTS = ("order", "info")
+
+ORDER_VERBS = r"(order|reorder|buy|purchase|need|want|request|send|ship|supply|deliver|book|place|get)"
+ORDER_UNITS = r"(units?|pcs|pieces|nos|tyres?|tires?)"
+ORDER_RULES = [
+    re.compile(r"\bplac(e|ing)\s+(an?\s+|the\s+|new\s+|this\s+)*orders?\b", re.IGNORECASE),
+    re.compile(r"\b" + ORDER_VERBS + r"\b\s+(me\s+|us\s+)?\d+", re.IGNORECASE),
+    # A quantity with a unit is an order even without a verb ("20 units of ...", "15 SpeedoCruze tyres")
+    re.compile(r"\b\d+\s*([a-z0-9/\-]+\s+){0,3}?" + ORDER_UNITS + r"\b", re.IGNORECASE),
+]
+ORDER_VOCABULARY = re.compile(r"\b" + ORDER_VERBS + r"\b", re.IGNORECASE)
+# A number standing on its own (not part of an identifier like P123 or 100/35R24) may be a quantity
+BARE_NUMBER = re.compile(r"(?<![\w/])\d+(?![\w/])")
+
+IntentGuess = namedtuple("IntentGuess", "intent confidence source")   # intent None = ask the LLM
+
+
+def rule_intent(user_query):
+    """(intent, confidence) from the keyword rules, or (None, 0.0)"""
+    text = user_query or ""
+    if any(rule.search(text) for rule in ORDER_RULES):
+        return "order", 0.99
+    # Order vocabulary or a possible quantity is never plainly info, even phrased as a
+    # question ("Is it possible to order SpeedoCruze, quantity 20?"): leave it to the model
+    if ORDER_VOCABULARY.search(text) or BARE_NUMBER.search(text):
+        return None, 0.0
+    return "info", 0.99
+
+
+class NaiveBayes:
+    """Multinomial naive Bayes over lexical_index.tokenize terms, add-one smoothing"""
+
+    def __init__(self, doc_counts=None, term_counts=None, report=None):
+        self.doc_counts = doc_counts or {intent: 0 for intent in INTENTS}
+        self.term_counts = term_counts or {intent: {} for intent in INTENTS}
+        self.report = report or {}
+        self._prepare()
+
+    def _prepare(self):
+        self.vocabulary = set()
+        for counts in self.term_counts.values():
+            self.vocabulary.update(counts)
+        self.totals = {intent: sum(counts.values()) for intent, counts in self.term_counts.items()}
+
+    def fit(self, queries, labels):
+        for query, label in zip(queries, labels):
+            self.doc_counts[label] = self.doc_counts.get(label, 0) + 1
+            counts = self.term_counts.setdefault(label, {})
+            for term, tf in Counter(tokenize(query)).items():
+                counts[term] = counts.get(term, 0) + tf
+        self._prepare()
+        return self
+
+    def probabilities(self, query):
+        n_docs = sum(self.doc_counts.values())
+        if not n_docs:
+            return {}
+        terms = tokenize(query)
+        size = len(self.vocabulary) or 1
+        log_scores = {}
+        for intent in INTENTS:
+            score = math.log((self.doc_counts.get(intent, 0) + 1) / (n_docs + len(INTENTS)))
+            counts = self.term_counts.get(intent, {})
+            denominator = self.totals.get(intent, 0) + size
+            for term in terms:
+                if term in self.vocabulary:
+                    score += math.log((counts.get(term, 0) + 1) / denominator)
+            log_scores[intent] = score
+        top = max(log_scores.values())
+        exp_scores = {intent: math.exp(score - top) for intent, score in log_scores.items()}
+        total = sum(exp_scores.values())
+        return {intent: value / total for intent, value in exp_scores.items()}
+
+    def to_dict(self):
+        return {"doc_counts": self.doc_counts, "term_counts": self.term_counts, "report": self.report}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["doc_counts"], data["term_counts"], data.get("report"))
+
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+_outcomes = {}   # (source, local intent) -> {"decided", "checked", "agreed"}
+_outcome_lock = threading.Lock()
+
+
+def get_model():
+    """The trained model from INTENT_MODEL_PATH, or None (rules only)"""
+    global _model, _model_loaded
+    if not _model_loaded:
+        with _model_lock:
+            if not _model_loaded:
+                try:
+                    with open(INTENT_MODEL_PATH, "r", encoding="utf-8") as f:
+                        _model = NaiveBayes.from_dict(json.load(f))
+                    print(f"DEBUG: Intent model loaded from {INTENT_MODEL_PATH}")
+                except FileNotFoundError:
+                    print("DEBUG: No intent model found, using keyword rules only")
+                except Exception as e:
+                    print(f"DEBUG: Failed to load intent model: {e}")
+                _model_loaded = True
+    return _model
+
+
+def classify(user_query):
+    """IntentGuess for a message; intent is None inside the ambiguous band"""
+    intent, confidence = rule_intent(user_query)
+    if intent is not None:
+        guess = IntentGuess(intent, confidence, "rule")
+    else:
+        guess = IntentGuess(None, 0.0, "llm")
+        model = get_model()
+        if model is not None:
+            probabilities = model.probabilities(user_query)
+            if probabilities:
+                intent = max(probabilities, key=probabilities.get)
+                if probabilities[intent] >= INTENT_CONFIDENCE:
+                    guess = IntentGuess(intent, round(probabilities[intent], 3), "model")
+    print(f"DEBUG: Local intent: {guess.intent or 'ambiguous'} ({guess.source}, {guess.confidence})")
+    _count(guess, "decided")
+    return guess
+
+
+def _count(guess, counter):
+    if guess.intent is None:
+        return
+    with _outcome_lock:
+        stats = _outcomes.setdefault((guess.source, guess.intent), {"decided": 0, "checked": 0, "agreed": 0})
+        stats[counter] += 1
+
+
+def record(guess, llm_intent):
+    """Compare a local decision with the intent the LLM gave for the same message"""
+    if guess.intent is None or llm_intent not in INTENTS:
+        return
+    _count(guess, "checked")
+    if guess.intent == llm_intent:
+        _count(guess, "agreed")
+    else:
+        print(f"DEBUG: Local intent {guess.intent} ({guess.source}) disagreed with LLM intent {llm_intent}")
+
+
+def record_plan(guess, plan_task):
+    """record() against a running plan_query task once it finishes, without waiting for it"""
+    def check(task):
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            record(guess, task.result().intent)
+    plan_task.add_done_callback(check)
+
+
+def stats():
+    """Running precision of local decisions, checked against the LLM where it ran"""
+    with _outcome_lock:
+        outcomes = {f"{source}:{intent}": dict(values) for (source, intent), values in _outcomes.items()}
+    for values in outcomes.values():
+        values["precision"] = round(values["agreed"] / values["checked"], 3) if values["checked"] else None
+    model = get_model()
+    return {"confidence": INTENT_CONFIDENCE, "outcomes": outcomes,
+            "model": model.report if model is not None else None}
+
+
+# === Offline training ===
+def fetch_logged_queries(client, limit=None, page_size=1000):
+    queries, seen, start = [], set(), 0
+    while limit is None or len(queries) < limit:
+        rows = client.table("conversation_logs").select("user_query").range(start, start + page_size - 1).execute().data or []
+        for row in rows:
+            query = (row.get("user_query") or "").strip()
+            if query and query.lower() not in seen:
+                seen.add(query.lower())
+                queries.append(query)
+        if len(rows) < page_size:
+            break
+        start += page_size
+    return queries[:limit] if limit else queries
+
+
+def evaluate(model, queries, labels, confidence=INTENT_CONFIDENCE):
+    """Precision / coverage of rules, model and rules + model on labelled queries"""
+    report = {}
+    decisions = {"rules": [], "model": [], "combined": []}
+    for query, label in zip(queries, labels):
+        rule, _ = rule_intent(query)
+        probabilities = model.probabilities(query)
+        predicted = max(probabilities, key=probabilities.get) if probabilities else None
+        confident = predicted if predicted and probabilities[predicted] >= confidence else None
+        decisions["rules"].append((rule, label))
+        decisions["model"].append((confident, label))
+        decisions["combined"].append((rule or confident, label))
+    for name, pairs in decisions.items():
+        decided = [(p, l) for p, l in pairs if p is not None]
+        report[name] = {"coverage": round(len(decided) / len(pairs), 3) if pairs else 0.0}
+        for intent in INTENTS:
+            hits = [l for p, l in decided if p == intent]
+            report[name][f"precision_{intent}"] = round(hits.count(intent) / len(hits), 3) if hits else None
+            report[name][f"decided_{intent}"] = len(hits)
+    report["confidence"] = confidence
+    report["examples"] = len(queries)
+    return report
+
+
+def print_report(report):
+    print(f"{'decider':<10}{'coverage':>10}{'P(order)':>10}{'n':>6}{'P(info)':>10}{'n':>6}")
+    for name in ("rules", "model", "combined"):
+        line = report.get(name)
+        if not line:
+            continue
+        fmt = lambda value: f"{value:.3f}" if value is not None else "-"
+        print(f"{name:<10}{line['coverage']:>10.3f}{fmt(line['precision_order']):>10}{line['decided_order']:>6}"
+              f"{fmt(line['precision_info']):>10}{line['decided_info']:>6}")
+    print(f"holdout examples: {report.get('examples')}, confidence band: {report.get('confidence')}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Train / evaluate the local intent classifier")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    train_parser = subcommands.add_parser("train", help="Label logged queries with the LLM and fit the model")
+    train_parser.add_argument("--limit", type=int, default=2000)
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    train_parser.add_argument("--output", default=INTENT_MODEL_PATH)
+    subcommands.add_parser("report", help="Print the saved model's holdout precision")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        from supabase_client import supabase
+        from rag import extract_order_details
+
+        queries, labels = [], []
+        for query in fetch_logged_queries(supabase, args.limit):
+            intent = extract_order_details(query).get("intent")
+            if intent in INTENTS:
+                queries.append(query)
+                labels.append(intent)
+        print(f"Labelled {len(queries)} queries: {dict(Counter(labels))}")
+        pairs = list(zip(queries, labels))
+        random.Random(0).shuffle(pairs)
+        split = int(len(pairs) * (1 - args.holdout))
+        train, holdout = pairs[:split], pairs[split:]
+        model = NaiveBayes().fit(*zip(*train)) if train else NaiveBayes()
+        model.report = evaluate(model, *zip(*holdout)) if holdout else {}
+        print_report(model.report)
+        # Refit on everything for the shipped model; the report stays the holdout estimate
+        model = NaiveBayes(report=model.report).fit(queries, labels)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(model.to_dict(), f)
+        print(f"Model written to {args.output}")
+
+    elif args.command == "report":
+        model = get_model()
+        if model is None or not model.report:
+            parser.error(f"No trained model at {INTENT_MODEL_PATH}")
+        print_report(model.report)
@@ -6,8 +6,9 @@ import asyncpg
 import ssl
 from dotenv import load_dotenv
 from supabase_client import supabase  # You must define supabase client elsewhere
-import requests
-import time
+from index_listener import notify_vector_store_change
+import llm_client
+import embedding_cache
 
 load_dotenv()
 
@@ -22,7 +23,7 @@ def generate_inventory_description(metadata):
     )
 
 # === Generate embedding ===
-def get_embedding_with_retry(payload, max_retries=5):
+async def get_embedding_with_retry(payload, max_retries=5):
     delay = 3
     endpoint = os.getenv("AZURE_EMBEDDING_URL")
     headers = {
@@ -37,13 +38,20 @@ def get_embedding_with_retry(payload, max_retries=5):
     if endpoint is None:
         raise ValueError("AZURE_EMBEDDING_URL environment variable is not set.")
 
+    text = embedding_cache.payload_text(payload)
+    cached = embedding_cache.lookup(text)
+    if cached is not None:
+        return cached
+
     for attempt in range(max_retries):
-        res = requests.post(endpoint, headers=headers, json=payload)
+        res = await llm_client.apost(endpoint, headers=headers, json=payload)
         if res.status_code == 200:
-            return res.json()["data"][0]["embedding"]
+            embedding = res.json()["data"][0]["embedding"]
+            embedding_cache.store(text, embedding)
+            return embedding
         elif res.status_code == 429:
             print(f"⚠️ Rate limit hit. Retrying in {delay * (2 ** attempt)} seconds...")
-            time.sleep(delay * (2 ** attempt))
+            await asyncio.sleep(delay * (2 ** attempt))
         else:
             raise Exception(f"Embedding failed: {res.status_code} - {res.text}")
     raise Exception("Max retries exceeded.")
@@ -89,7 +97,7 @@ async def handle_inventory_update(conn, pid, channel, payload):
 
         # Generate new description and embedding
         description = generate_inventory_description(meta)
-        embedding = get_embedding_with_retry({"input": [description]})
+        embedding = await get_embedding_with_retry({"input": [description]})
 
         # Update vector_store row
         supabase.table("vector_store").update({
@@ -98,6 +106,9 @@ async def handle_inventory_update(conn, pid, channel, payload):
             "metadata": json.dumps(meta)
         }).eq("id", vector_id).execute()
 
+        # API workers replace the stale entry in their vector index (index_listener.py)
+        await notify_vector_store_change(conn, vector_id, found_row.get("table_join"))
+
         print(f"✅ vector_store updated successfully for product {product_id} in warehouse {warehouse_id}")
 
     except Exception as e:
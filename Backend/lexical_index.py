@@ -0,0 +1,152 @@
+import re
+from collections import Counter
+import numpy as np
+
+# === Lexical (BM25) index over vector_store.description ===
+# Dense embeddings rank exact identifiers (tyre sizes like 100/35R24 50P, ORD0042,
+# CLM0012) poorly. This inverted index is kept next to the vectors in VectorIndex,
+# slot for slot, and its ranking is fused with the cosine ranking (reciprocal rank
+# fusion), so identifier queries resolve from the postings alone.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[/\-.][a-z0-9]+)*")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it",
+    "its", "of", "on", "or", "the", "to", "was", "were", "with", "what", "which", "who", "show",
+    "me", "my", "all", "give", "list", "tell", "about", "details", "please", "can", "you", "i",
+}
+
+
+def tokenize(text):
+    """
+    Lowercased terms of a description or query. Compound identifiers are kept whole
+    and also split, so "100/35R24" matches both the full size and "35r24".
+    """
+    if not text:
+        return []
+    terms = []
+    for token in TOKEN_PATTERN.findall(str(text).lower()):
+        token = token.strip(".")
+        if not token or token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = re.split(r"[/\-.]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOPWORDS)
+    return terms
+
+
+def is_identifier(term):
+    """Terms mixing letters and digits (or joined by '/'), e.g. ord0042, clm0012, 100/35r24, 50p"""
+    return "/" in term or (any(c.isdigit() for c in term) and any(c.isalpha() for c in term))
+
+
+class LexicalIndex:
+    def __init__(self, size=0):
+        self.postings = {}   # term -> ([positions], [term frequencies])
+        self.lengths = np.zeros(size, dtype=np.float32)   # terms per slot
+        self.total_length = 0.0
+        self.size = size     # slots seen; VectorIndex adds every slot, in order
+
+    def add(self, pos, terms, live=False):
+        """
+        Index one slot. live=True when searches may be reading this index: new terms go into
+        a copy of the postings dict that is swapped in, so readers iterating it never see it
+        change size. Existing entries are appended to, frequencies before positions, so a
+        reader always finds a frequency for every position it read.
+        """
+        if pos >= self.lengths.size:
+            lengths = np.zeros(max(pos + 1, self.lengths.size * 2, 64), dtype=np.float32)
+            lengths[:self.lengths.size] = self.lengths
+            self.lengths = lengths
+        new_terms = {}
+        for term, tf in Counter(terms).items():
+            entry = self.postings.get(term)
+            if entry is None:
+                new_terms[term] = ([pos], [tf])
+            else:
+                entry[1].append(tf)
+                entry[0].append(pos)
+        if new_terms and live:
+            self.postings = {**self.postings, **new_terms}
+        elif new_terms:
+            self.postings.update(new_terms)
+        self.lengths[pos] = len(terms)
+        self.total_length += len(terms)
+        self.size = max(self.size, pos + 1)
+
+    def compacted(self, keep):
+        """New index holding only the given slots, renumbered 0..len(keep)-1"""
+        keep = np.asarray(keep, dtype=np.int64)
+        size = self.size   # slots added after this point are not in `keep`
+        remap = np.full(size, -1, dtype=np.int64)
+        remap[keep] = np.arange(keep.size)
+        index = LexicalIndex()
+        index.lengths = np.zeros(max(keep.size, 64), dtype=np.float32)
+        index.lengths[:keep.size] = self.lengths[keep]
+        index.total_length = float(index.lengths.sum())
+        index.size = int(keep.size)
+        for term, (positions, frequencies) in self.postings.items():
+            positions = np.asarray(positions, dtype=np.int64)
+            new_positions = remap[positions[positions < size]]
+            kept = new_positions >= 0
+            if kept.any():
+                frequencies = np.asarray(frequencies)[:kept.size][kept]
+                index.postings[term] = (new_positions[kept].tolist(), frequencies.tolist())
+        return index
+
+    def to_dict(self):
+        return {"lengths": self.lengths[:self.size].tolist(),
+                "postings": {term: [p, f] for term, (p, f) in self.postings.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        lengths = np.asarray(data["lengths"], dtype=np.float32)
+        index.lengths = np.zeros(max(lengths.size, 64), dtype=np.float32)
+        index.lengths[:lengths.size] = lengths
+        index.total_length = float(lengths.sum())
+        index.size = int(lengths.size)
+        index.postings = {term: (list(p), list(f)) for term, (p, f) in data["postings"].items()}
+        return index
+
+    def scores(self, terms, count, alive):
+        """BM25 score of every slot (< count) for the query terms; `alive` covers those slots, dead ones score 0"""
+        scores = np.zeros(count, dtype=np.float32)
+        n_docs = max(1, int(alive.sum()))
+        avg_length = self.total_length / max(1, self.size) or 1.0
+        lengths = self.lengths[:count]
+        for term in set(terms):
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            positions = np.asarray(entry[0], dtype=np.int64)
+            # Frequencies are appended first, so they cover every position read above
+            tf = np.asarray(entry[1], dtype=np.float32)[:positions.size]
+            in_view = positions < count
+            positions = positions[in_view]
+            tf = tf[in_view]
+            df = int(alive[positions].sum())
+            if df == 0:
+                continue
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[positions] / avg_length)
+            scores[positions] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        scores[~alive] = 0
+        return scores
+
+    def identifier_positions(self, terms, count, alive):
+        """Live slots (< count) containing every identifier term of the query, or None if it has none"""
+        identifiers = {term for term in terms if is_identifier(term)}
+        if not identifiers:
+            return None
+        matched = None
+        for term in identifiers:
+            entry = self.postings.get(term)
+            if entry is None:
+                return np.empty(0, dtype=np.int64)
+            positions = np.asarray(entry[0], dtype=np.int64)
+            positions = positions[positions < count]
+            matched = positions if matched is None else np.intersect1d(matched, positions)
+        return matched[alive[matched]]
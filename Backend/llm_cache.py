@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Cache for deterministic LLM sub-calls ===
+# get_llm_sql, extract_metadata_with_llm, extract_order_details, rewrite_query_for_rag and
+# plan_query run at (near) zero temperature, so the same question from the same role scope
+# gets the same answer. Entries are keyed on
+#   (stage, prompt version, normalised query, role, dealer_id, sales_rep_id)
+# and held in a per-process LRU with a TTL. With LLM_CACHE_PATH set, entries are also written
+# to a SQLite file that every worker on the host reads, so a question answered by one
+# worker is a hit for the others. Bump a stage's prompt version whenever its prompt changes.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))       # entries per process
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))       # seconds
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH") or None           # optional shared SQLite file
+
+
+def normalize_query(text):
+    """Case, surrounding/repeated whitespace and trailing punctuation don't change the answer"""
+    text = re.sub(r"\s+", " ", str(text or "")).strip().lower()
+    return text.rstrip("?!. ")
+
+
+class DiskStore:
+    """SQLite backing store shared by the workers on one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[1], json.loads(row[0])
+
+    def set(self, key, value, expires_at):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), expires_at))
+
+    def purge_expired(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+
+
+class LLMCache:
+    def __init__(self, max_entries=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL, path=LLM_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (expires_at, value), least recently used first
+        self.lock = threading.Lock()
+        self.counters = {}             # stage -> {"hits", "misses", "stores"}
+        self.disk = None
+        if path:
+            try:
+                self.disk = DiskStore(path)
+                self.disk.purge_expired()
+            except Exception as e:
+                print(f"DEBUG: LLM cache disk store unavailable ({e}), using memory only")
+
+    def _count(self, stage, counter):
+        with self.lock:
+            stats = self.counters.setdefault(stage, {"hits": 0, "misses": 0, "stores": 0})
+            stats[counter] += 1
+
+    def get(self, stage, key):
+        """(True, value) on a hit, (False, None) on a miss"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self.entries.move_to_end(key)
+                else:
+                    del self.entries[key]
+                    entry = None
+        if entry is None and self.disk is not None:
+            try:
+                entry = self.disk.get(key)
+            except Exception as e:
+                print(f"DEBUG: LLM cache disk read failed: {e}")
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self._count(stage, "misses")
+            return False, None
+        self._count(stage, "hits")
+        return True, json.loads(json.dumps(entry[1]))   # callers may mutate what they get back
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set(self, stage, key, value):
+        expires_at = time.time() + self.ttl
+        value = json.loads(json.dumps(value))
+        self._remember(key, (expires_at, value))
+        self._count(stage, "stores")
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value, expires_at)
+            except Exception as e:
+                print(f"DEBUG: LLM cache disk write failed: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            stages = {stage: dict(stats) for stage, stats in self.counters.items()}
+            size = len(self.entries)
+        for stats in stages.values():
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return {"enabled": LLM_CACHE_ENABLED, "entries": size, "max_entries": self.max_entries,
+                "ttl": self.ttl, "shared": self.disk is not None, "stages": stages}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_call_state = threading.local()
+
+
+def get_llm_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMCache()
+    return _cache
+
+
+def stats():
+    return get_llm_cache().stats()
+
+
+def make_key(stage, prompt_version, user_query, scope=()):
+    parts = [stage, str(prompt_version), normalize_query(user_query)] + [
+        None if value is None else str(value) for value in scope]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def dont_store():
+    """Called inside a cached function when it is about to return a fallback instead of an LLM answer"""
+    _call_state.failed = True
+
+
+def cached(stage, prompt_version, scope=None, skip=None, failed=None):
+    """
+    Cache a `func(user_query)` LLM sub-call.
+    scope(): the role scope tuple the answer depends on (role, dealer_id, sales_rep_id).
+    skip(user_query): True when the answer depends on more than the query (follow-ups).
+    failed(result): True for fallback results; None results, exceptions and calls that
+    signalled dont_store() are never cached either.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user_query):
+            if not LLM_CACHE_ENABLED or (skip is not None and skip(user_query)):
+                return func(user_query)
+            cache = get_llm_cache()
+            key = make_key(stage, prompt_version, user_query, scope() if scope else ())
+            hit, value = cache.get(stage, key)
+            if hit:
+                print(f"DEBUG: LLM cache hit ({stage})")
+                return value
+            _call_state.failed = False
+            result = func(user_query)
+            if result is None or _call_state.failed or (failed is not None and failed(result)):
+                return result
+            cache.set(stage, key, result)
+            return result
+        return wrapper
+    return decorator
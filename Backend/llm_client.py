@@ -0,0 +1,123 @@
+import os
+import asyncio
+import threading
+import json as jsonlib
+import httpx
+import timing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Shared HTTP clients for the Azure chat / embedding gateway ===
+# One pooled client per process (and one async client per event loop), so calls reuse
+# kept-alive connections instead of paying a TCP + TLS handshake each time.
+# Responses are httpx.Response objects: status_code / json() / text / raise_for_status()
+# work the same as they did with requests.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))                  # seconds per request
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() == "true"         # needs the h2 package
+
+_sync_client = None
+_async_clients = {}   # event loop -> httpx.AsyncClient
+_client_lock = threading.Lock()
+
+
+def _client_options():
+    http2 = LLM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("DEBUG: LLM_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+            http2 = False
+    return {
+        "http2": http2,
+        "timeout": httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE),
+    }
+
+
+def get_client():
+    """The process-wide pooled client for blocking callers (worker threads, scripts)"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                _sync_client = httpx.Client(**_client_options())
+    return _sync_client
+
+
+def get_async_client():
+    """The pooled async client for the running event loop (FastAPI handlers, asyncpg listeners)"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(**_client_options())
+        _async_clients[loop] = client
+    return client
+
+
+def _headers(headers):
+    # The header dicts are built from os.getenv; requests skipped unset (None) values, httpx rejects them
+    return {k: v for k, v in (headers or {}).items() if v is not None}
+
+
+def _record(payload, response):
+    """Payload sizes and token usage of a call, for the running timing stage"""
+    usage = None
+    if response.status_code == 200 and "json" in response.headers.get("content-type", ""):
+        try:
+            usage = response.json().get("usage")
+        except ValueError:
+            pass
+    timing.add(llm_calls=1, bytes_out=len(jsonlib.dumps(payload)) if payload is not None else 0,
+               bytes_in=len(response.content))
+    timing.record_usage(usage)
+
+
+def post(url, headers=None, json=None, timeout=None):
+    """POST through the shared client; timeout (seconds) overrides LLM_TIMEOUT for this call"""
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    response = get_client().post(str(url), headers=_headers(headers), json=json, **kwargs)
+    _record(json, response)
+    return response
+
+
+async def apost(url, headers=None, json=None, timeout=None):
+    """Async POST through the event loop's shared client"""
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    response = await get_async_client().post(str(url), headers=_headers(headers), json=json, **kwargs)
+    _record(json, response)
+    return response
+
+
+async def astream_lines(url, headers=None, json=None, timeout=None):
+    """
+    Async POST whose response body is read line by line as it arrives (server-sent events).
+    Raises httpx.HTTPStatusError for non-2xx responses.
+    """
+    kwargs = {"timeout": timeout} if timeout is not None else {}
+    timing.add(llm_calls=1, bytes_out=len(jsonlib.dumps(json)) if json is not None else 0)
+    async with get_async_client().stream("POST", str(url), headers=_headers(headers), json=json, **kwargs) as response:
+        if response.status_code >= 400:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            timing.add(bytes_in=len(line) + 1)
+            yield line
+
+
+async def close_clients():
+    """Close the pooled clients (application shutdown)"""
+    global _sync_client
+    loop = asyncio.get_running_loop()
+    for client_loop, client in list(_async_clients.items()):
+        if client_loop is loop:
+            await client.aclose()
+    _async_clients.clear()
+    with _client_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
@@ -0,0 +1,135 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === Write-behind conversation log writer ===
+# save_to_supabase only enqueues its conversation_logs row; a background thread inserts
+# queued rows in batches (LOG_BATCH_SIZE rows or every LOG_FLUSH_INTERVAL seconds), so
+# logging adds no latency to /api/query. The queue is bounded: when Supabase falls behind,
+# new rows are dropped and counted rather than growing memory. stop() drains the queue on
+# application shutdown (and atexit for scripts).
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))   # seconds
+LOG_RETRIES = int(os.getenv("LOG_RETRIES", "2"))                   # extra attempts per batch
+
+
+class LogWriter:
+    def __init__(self, client, table="conversation_logs", max_queue=LOG_QUEUE_SIZE,
+                 batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        self.client = client
+        self.table = table
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.counters = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+        self.last_flush_ms = None
+        self.last_error = None
+        self.lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def start(self):
+        with self.lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, record):
+        """Queue a row without blocking; returns False when the queue is full and it was dropped"""
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("enqueued")
+        return True
+
+    def _next_batch(self):
+        """Up to batch_size rows, waiting at most flush_interval for the batch to fill"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or (self._stopping.is_set() and self.queue.empty()):
+                break
+            try:
+                batch.append(self.queue.get(timeout=min(timeout, 0.25)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        for attempt in range(LOG_RETRIES + 1):
+            try:
+                self.client.table(self.table).insert(batch).execute()
+                self._count("written", len(batch))
+                self._count("batches")
+                self.last_flush_ms = round((time.perf_counter() - start) * 1000, 1)
+                return
+            except Exception as e:
+                self.last_error = str(e)
+                if attempt < LOG_RETRIES and not self._stopping.is_set():
+                    time.sleep(0.5 * (2 ** attempt))
+        print(f"DEBUG: Dropping {len(batch)} conversation log rows after failed inserts: {self.last_error}")
+        self._count("failed", len(batch))
+
+    def _run(self):
+        while not (self._stopping.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def stop(self, timeout=10):
+        """Flush what is queued and stop the thread (application shutdown)"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+            if thread.is_alive():
+                print(f"DEBUG: Log writer did not finish within {timeout}s, {self.queue.qsize()} rows left unwritten")
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["queue_capacity"] = self.queue.maxsize
+        stats["last_flush_ms"] = self.last_flush_ms
+        stats["last_error"] = self.last_error
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer(client):
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(client)
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def stop():
+    if _writer is not None:
+        _writer.stop()
+
+
+def stats():
+    return _writer.stats() if _writer is not None else {"running": False, "queue_depth": 0}
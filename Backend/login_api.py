@@ -1,23 +1,173 @@
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from supabase_client import supabase
 from rag import (
-    authenticate_user, current_user, get_conversation_context, UserSession, get_llm_sql,
+    authenticate_user, set_current_user, get_conversation_context, UserSession, get_llm_sql,
     clean_sql_output, try_select_sql, sql_result_to_context, rewrite_query_for_rag,
     preprocess_query, get_embedding, extract_metadata_with_llm,
-    vector_store_similarity_search, vector_rows_to_context, get_llm_final_response,
+    vector_store_similarity_search, route_table_joins, vector_rows_to_context, get_llm_final_response,
+    stream_llm_final_response, is_follow_up_question, save_to_supabase,
     get_user_by_username, create_order_request, extract_order_details, resolve_product_id, resolve_dealer_id, place_order, resolve_warehouse_id
 )
+from query_planner import plan_query
+import answer_cache
+import intent_classifier
+from sql_templates import match_template
+import timing
 import sys
 import psycopg2
 import os
+import json
+import asyncio
 
 router = APIRouter()
 pending_orders = {}
 
+# Start the SQL + RAG pipeline before the intent of an ambiguous message is known (see handle_query)
+SPECULATIVE_INFO_PIPELINE = os.getenv("SPECULATIVE_INFO_PIPELINE", "false").lower() == "true"
+
+
+def emit(events, event, data):
+    """Queue an event for /api/query/stream; no-op for the plain JSON endpoint"""
+    if events is not None:
+        events.put_nowait((event, data))
+
+
+# === Info pipeline (SQL + RAG) ===
+# Independent chains run concurrently in worker threads:
+#   get_llm_sql -> try_select_sql -> sql_result_to_context
+#   plan_query -> get_embedding(plan rewrite) -> vector_store_similarity_search -> vector_rows_to_context
+# so the answer waits on the longest chain instead of the sum of every round trip.
+# Without a plan the RAG chain falls back to rewrite_query_for_rag -> get_embedding
+# alongside extract_metadata_with_llm.
+# Both chains also report the tables their context came from (for answer_cache);
+# None when a step failed and the answer should not be cached.
+def run_sql_chain(user_query):
+    # Built-in templates are rendered locally; follow-ups need the history-aware LLM prompt
+    template = None if is_follow_up_question(user_query) else match_template(user_query)
+    if template is not None:
+        sql, params = template["sql"], template["params"]
+    else:
+        sql, params = clean_sql_output(get_llm_sql(user_query)), None
+    print("DEBUG: SQL:", sql)
+    sql_context = "No results found."
+    tables = set()
+    if sql.strip().upper() != "NO_SQL" and sql.strip().lower().startswith("select"):
+        sql_result, sql_error = try_select_sql(sql, params)
+        tables = None if sql_error else answer_cache.tables_from_sql(sql)
+        if sql_result:
+            sql_context = sql_result_to_context(sql_result)
+            print("SQL Result:", sql_context)
+            print("=" * 50)
+    return sql_context, tables
+
+
+def run_embedding_chain(user_query):
+    rewritten_query = rewrite_query_for_rag(user_query)
+    return get_embedding(preprocess_query(rewritten_query))
+
+
+async def run_info_pipeline(user_query, plan_task=None, events=None):
+    """Returns (sql_context, rag_context, tables) for an info question; plan_task is a running plan_query"""
+    emit(events, "progress", {"stage": "sql", "message": "Generating SQL"})
+    sql_task = asyncio.create_task(asyncio.to_thread(run_sql_chain, user_query))
+    try:
+        plan = await plan_task if plan_task is not None else None
+        if plan is not None:
+            metadata_filter = plan.metadata()
+            query_embedding = await asyncio.to_thread(get_embedding, preprocess_query(plan.retrieval_query(user_query)))
+        else:
+            query_embedding, metadata_filter = await asyncio.gather(
+                asyncio.to_thread(run_embedding_chain, user_query),
+                asyncio.to_thread(extract_metadata_with_llm, user_query)
+            )
+        emit(events, "progress", {"stage": "search", "message": "Searching"})
+        vector_rows = await asyncio.to_thread(
+            vector_store_similarity_search,
+            query_embedding,
+            top_k=10,
+            metadata_filter=metadata_filter,
+            similarity_threshold=0.08,
+            table_joins=route_table_joins(user_query, metadata_filter),
+            query_text=user_query
+        )
+        rag_context = vector_rows_to_context(vector_rows) if vector_rows else "No relevant vector context found."
+        if vector_rows:
+            print("RAG Vector Search Result:")
+            print(rag_context)
+        else:
+            print("RAG Vector Search: No relevant results found.")
+        sql_context, tables = await sql_task
+    finally:
+        if not sql_task.done():
+            sql_task.cancel()
+    if tables is not None:
+        tables |= answer_cache.tables_from_rows(vector_rows)
+    return sql_context, rag_context, tables
+
+def log_exchange(request, result):
+    """Queue an answered exchange for conversation_logs (write-behind, no added latency)"""
+    user_session = getattr(request.state, "user_session", None)
+    if user_session is not None and isinstance(result, dict) and result.get("answer"):
+        save_to_supabase(request.state.user_query, result["answer"], user_session)
+
+
 @router.post("/api/query")
 async def query(request: Request):
     print("🚀 [DEBUG] /api/query endpoint hit")
+    result = await handle_query(request)
+    log_exchange(request, result)
+    return result
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@router.post("/api/query/stream")
+async def query_stream(request: Request):
+    """
+    /api/query as server-sent events: `progress` events while the pipeline runs, `delta`
+    events with answer text as the chat model produces it, then `done` with the same
+    object /api/query returns (or `error`).
+    """
+    print("🚀 [DEBUG] /api/query/stream endpoint hit")
+    # Read (and cache) the body now: it cannot be received once the response is streaming
+    await request.body()
+    events = asyncio.Queue()
+
+    async def event_stream():
+        task = asyncio.create_task(handle_query(request, events))
+        try:
+            while True:
+                getter = asyncio.create_task(events.get())
+                done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    yield sse_event(*getter.result())
+                    continue
+                getter.cancel()
+                break
+            while not events.empty():
+                yield sse_event(*events.get_nowait())
+            result = task.result()
+            log_exchange(request, result)
+            if isinstance(result, JSONResponse):
+                yield sse_event("error", json.loads(result.body))
+            else:
+                # The Server-Timing header went out with the first byte; the full breakdown goes here
+                yield sse_event("done", {**result, "timing": timing.current_summary()})
+        finally:
+            # Client went away mid-stream
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def handle_query(request, events=None):
+    """Shared body of /api/query and /api/query/stream (events is the stream's queue)"""
+    info_task = None
     try:
         data = await request.json()
         username = data.get("username")
@@ -26,7 +176,7 @@ async def query(request: Request):
         print(f"👤 [DEBUG] Incoming query from user: {username}")
         print(f"💬 [DEBUG] User query: {user_query}")
 
-        user_session = get_user_by_username(username)
+        user_session = await asyncio.to_thread(get_user_by_username, username)
         print(f"[DEBUG] get_user_by_username result: {user_session}")
         if user_session:
             print(f"[DEBUG] user_session.sales_rep_id: {user_session.sales_rep_id}")
@@ -36,12 +186,10 @@ async def query(request: Request):
             print(f"❌ [ERROR] No matching user found for username: {username}")
             return JSONResponse(status_code=401, content={"success": False, "message": f"Unauthorized: No user found for {username}"})
 
-        import rag
-        rag.current_user = user_session
-
-        if rag.current_user is None:
-            print("ERROR: current_user is not set!")
-            return ""
+        # Context-local: the planner / pipeline tasks and their worker threads inherit it
+        set_current_user(user_session)
+        request.state.user_session = user_session
+        request.state.user_query = user_query
 
         confirmation_phrases = ["yes", "confirm", "place order", "yep", "sure", "okay", "ok"]
         negative_phrases = ["no", "cancel", "don't", "do not", "nah"]
@@ -100,23 +248,23 @@ async def query(request: Request):
         # --- Confirmation step ---
         if any(phrase in user_query.lower() for phrase in confirmation_phrases):
             print(f"[DEBUG] Checking for pending order for sales_rep_id: {user_session.sales_rep_id}")
-            pending_order = get_pending_order_for_sales_rep(user_session.sales_rep_id)
+            pending_order = await asyncio.to_thread(get_pending_order_for_sales_rep, user_session.sales_rep_id)
             print(f"[DEBUG] Pending order found: {pending_order}")
             if pending_order:
                 print(f"[DEBUG] Attempting to place order with details: {pending_order}")
-                response_obj = place_order(
-                    pending_order["dealer_id"], pending_order["product_id"], pending_order["quantity"], pending_order.get("warehouse_id")
+                response_obj = await asyncio.to_thread(
+                    place_order, pending_order["dealer_id"], pending_order["product_id"], pending_order["quantity"], pending_order.get("warehouse_id")
                 )
                 print(f"[DEBUG] place_order response: {response_obj}")
                 if response_obj["success"]:
-                    mark_order_request_placed(pending_order["request_id"])
+                    await asyncio.to_thread(mark_order_request_placed, pending_order["request_id"])
                     details = response_obj.get("details", {})
                     ai_prompt = (
                         f"The sales representative has successfully placed an order for dealer '{pending_order['dealer_id']}' "
                         f"of {pending_order['quantity']} units of product '{pending_order['product_id']}'. "
                         f"Generate a friendly, professional confirmation message for the sales rep, including the order details: {details}."
                     )
-                    ai_response = get_llm_final_response("", "", ai_prompt)
+                    ai_response = await asyncio.to_thread(get_llm_final_response, "", "", ai_prompt)
                     print(f"[DEBUG] AI confirmation response: {ai_response}")
                     return {"success": True, "answer": ai_response, "details": details}
                 else:
@@ -124,7 +272,7 @@ async def query(request: Request):
                         f"Failed to place an order for dealer '{pending_order['dealer_id']}'. "
                         f"Reason: {response_obj['message']}. Generate a helpful error message for the sales rep."
                     )
-                    ai_response = get_llm_final_response("", "", ai_prompt)
+                    ai_response = await asyncio.to_thread(get_llm_final_response, "", "", ai_prompt)
                     print(f"[DEBUG] AI error response: {ai_response}")
                     return {"success": False, "answer": ai_response}
             else:
@@ -134,17 +282,63 @@ async def query(request: Request):
             # Optionally, you can mark the pending order as 'cancelled' in the DB
             return {"success": True, "answer": "❌ Order cancelled."}
 
+        # Plain info messages (and all admin messages: admins have no order path) start the
+        # SQL + RAG pipeline right away. Anything else waits for the plan's intent first:
+        # worker-thread work cannot be cancelled, so on an order the SQL generation, embedding
+        # and query would still run and count against the LLM provider's rate limits.
+        # SPECULATIVE_INFO_PIPELINE=true starts it anyway for ambiguous messages, paying those
+        # calls on orders to save the planner's latency on info questions.
+        intent_guess = intent_classifier.classify(user_query) if not user_session.is_admin() else None
+        local_info = intent_guess is None or intent_guess.intent == "info"
+        speculate = local_info or (SPECULATIVE_INFO_PIPELINE and intent_guess.intent is None)
+
+        # One planner call covers intent, order fields, metadata filter and rewrite
+        emit(events, "progress", {"stage": "plan", "message": "Understanding the question"})
+        plan_task = asyncio.create_task(asyncio.to_thread(plan_query, user_query))
+        if speculate:
+            info_task = asyncio.create_task(run_info_pipeline(user_query, plan_task, events))
+
+        # --- Answer cache: near-identical info questions from this user, data unchanged ---
+        # Looked up while the planner (and pipeline) are already running; a hit drops them
+        answer_scope = None
+        query_embedding = None
+        if answer_cache.is_cacheable_query(user_query) and not is_follow_up_question(user_query):
+            answer_scope = (user_session.user_id, user_session.role, user_session.dealer_id, user_session.sales_rep_id)
+            try:
+                query_embedding = await asyncio.to_thread(get_embedding, preprocess_query(user_query))
+                cached_answer = answer_cache.lookup(answer_scope, query_embedding, user_query)
+            except Exception as e:
+                print(f"DEBUG: Answer cache lookup failed: {e}")
+                answer_scope, cached_answer = None, None
+            if cached_answer:
+                plan_task.cancel()
+                emit(events, "delta", {"text": cached_answer})
+                return {"success": True, "answer": cached_answer, "cached": True}
+
+        async def get_order_details():
+            if intent_guess is not None and intent_guess.intent == "info":
+                intent_classifier.record_plan(intent_guess, plan_task)
+                return {"intent": "info"}
+            plan = await plan_task
+            if plan is not None:
+                extracted = plan.order_details()
+            else:
+                extracted = await asyncio.to_thread(extract_order_details, user_query)
+            if intent_guess is not None:
+                intent_classifier.record(intent_guess, extracted.get("intent"))
+            return extracted
+
         # --- Dealer order request ---
         if user_session.is_dealer():
             print("DEBUG: User is dealer")
-            extracted = extract_order_details(user_query)
+            extracted = await get_order_details()
             intent = extracted.get("intent", "unknown")
             print("DEBUG: Dealer intent:", intent)
 
             if intent == "order":
                 product_id = extracted.get("product_id")
                 if not product_id and "product_name" in extracted:
-                    product_id = resolve_product_id(extracted["product_name"])
+                    product_id = await asyncio.to_thread(resolve_product_id, extracted["product_name"])
                     print(f"DEBUG: Resolved product_id for '{extracted['product_name']}': {product_id}")
                 quantity = extracted.get("quantity")
                 dealer_id = user_session.dealer_id
@@ -154,7 +348,7 @@ async def query(request: Request):
                     return {"success": False, "answer": "❌ Missing order details. Please specify product and quantity."}
 
                 # ✅ Insert order request
-                result = create_order_request(dealer_id, sales_rep_id, product_id, quantity)
+                result = await asyncio.to_thread(create_order_request, dealer_id, sales_rep_id, product_id, quantity)
                 print("DEBUG: create_order_request result:", result)
                 if result["success"]:
                     ai_prompt = (
@@ -162,20 +356,20 @@ async def query(request: Request):
                         f"of {quantity} units of product '{product_id}'. "
                         f"Generate a friendly, professional confirmation message for the dealer, mentioning that the order request has been sent to their sales representative."
                     )
-                    ai_response = get_llm_final_response("", "", ai_prompt)
+                    ai_response = await asyncio.to_thread(get_llm_final_response, "", "", ai_prompt)
                     return {"success": True, "answer": ai_response}
                 else:
                     ai_prompt = (
                         f"Failed to create an order request for dealer '{user_session.dealer_name}'. "
                         f"Reason: {result['message']}. Generate a helpful error message for the dealer."
                     )
-                    ai_response = get_llm_final_response("", "", ai_prompt)
+                    ai_response = await asyncio.to_thread(get_llm_final_response, "", "", ai_prompt)
                     return {"success": False, "answer": ai_response}
 
         # --- Sales rep order request (two-step confirmation) ---
-        if rag.current_user.is_sales_rep():
+        if user_session.is_sales_rep():
             print("DEBUG: User is sales rep")
-            extracted = extract_order_details(user_query)
+            extracted = await get_order_details()
             print("DEBUG: Extracted order details:", extracted)
             intent = extracted.get("intent", "unknown")
             print("DEBUG: Intent:", intent)
@@ -187,14 +381,14 @@ async def query(request: Request):
                 warehouse_id = extracted.get("warehouse_id")
 
                 if not dealer_id and "dealer_name" in extracted:
-                    dealer_id = resolve_dealer_id(extracted["dealer_name"])
+                    dealer_id = await asyncio.to_thread(resolve_dealer_id, extracted["dealer_name"])
                     print(f"DEBUG: Resolved dealer_id for '{extracted['dealer_name']}': {dealer_id}")
                 if not product_id and "product_name" in extracted:
-                    product_id = resolve_product_id(extracted["product_name"])
+                    product_id = await asyncio.to_thread(resolve_product_id, extracted["product_name"])
                     print(f"DEBUG: Resolved product_id for '{extracted['product_name']}': {product_id}")
 
                 if warehouse_id and not warehouse_id.startswith("W"):
-                    resolved_warehouse_id = resolve_warehouse_id(warehouse_id)
+                    resolved_warehouse_id = await asyncio.to_thread(resolve_warehouse_id, warehouse_id)
                     if resolved_warehouse_id:
                         warehouse_id = resolved_warehouse_id
 
@@ -202,14 +396,14 @@ async def query(request: Request):
                     return {"success": False, "answer": "❌ Missing order details. Please specify dealer, product, and quantity."}
                 
                 # Insert pending order into order_requests with status 'pending'
-                result = create_order_request(dealer_id, user_session.sales_rep_id, product_id, quantity)
+                result = await asyncio.to_thread(create_order_request, dealer_id, user_session.sales_rep_id, product_id, quantity)
                 print("DEBUG: create_order_request result:", result)
                 order_summary = f"Dealer: {dealer_id}, Product: {product_id}, Quantity: {quantity}"
                 ai_prompt = (
                         f"A dealer has requested an order: {order_summary}. "
                         f"Generate a message asking the sales rep to confirm before placing the order."
                     )
-                ai_response = get_llm_final_response("", "", ai_prompt)
+                ai_response = await asyncio.to_thread(get_llm_final_response, "", "", ai_prompt)
                 return {
                         "success": True,
                         "answer": ai_response
@@ -218,46 +412,48 @@ async def query(request: Request):
             elif intent != "info":
                 return {"success": False, "answer": "❌ Could not understand your intent. Please try rephrasing."}
 
-        sql = get_llm_sql(user_query)
-        sql = clean_sql_output(sql)
-        print("DEBUG: SQL:", sql)
-        sql_context = "No results found."
-        if sql.strip().upper() != "NO_SQL" and sql.strip().lower().startswith("select"):
-            sql_result, sql_error = try_select_sql(sql)
-            if sql_result:
-                sql_context = sql_result_to_context(sql_result)
-                print("SQL Result:", sql_context)
-                print("=" * 50)
-
-        rewritten_query = rewrite_query_for_rag(user_query)
-        query_embedding = get_embedding(preprocess_query(rewritten_query))
-        metadata_filter = extract_metadata_with_llm(user_query)
-        vector_rows = vector_store_similarity_search(
-            query_embedding,
-            top_k=10,
-            metadata_filter=metadata_filter,
-            similarity_threshold=0.08
-        )
-        rag_context = vector_rows_to_context(vector_rows) if vector_rows else "No relevant vector context found."
-        if vector_rows:
-            print("RAG Vector Search Result:")
-            print(rag_context)
-        else:
-            print("RAG Vector Search: No relevant results found.")
+        if info_task is None:
+            info_task = asyncio.create_task(run_info_pipeline(user_query, plan_task, events))
+        sql_context, rag_context, tables = await info_task
 
         print("=" * 50)
         print("Final Response Generation")
         print("=" * 50)
-        answer = get_llm_final_response(sql_context, rag_context, user_query=user_query)
+        if events is not None:
+            emit(events, "progress", {"stage": "answer", "message": "Generating answer"})
+            parts = []
+            try:
+                with timing.stage("final_answer"):
+                    async for delta in stream_llm_final_response(sql_context, rag_context, user_query):
+                        parts.append(delta)
+                        emit(events, "delta", {"text": delta})
+            except Exception as e:
+                # Cut off mid-answer: reported as an `error` event, neither cached nor logged
+                print(f"DEBUG: Answer stream interrupted after {len(parts)} deltas: {e}")
+                return JSONResponse(status_code=502, content={
+                    "success": False, "partial": True, "message": "The answer was interrupted. Please try again."})
+            answer = "".join(parts)
+        else:
+            answer = await asyncio.to_thread(get_llm_final_response, sql_context, rag_context, user_query=user_query)
         print(f"shivam : {answer}")
         sys.stdout.flush()
 
+        if answer_scope is not None and tables is not None:
+            answer_cache.store(answer_scope, query_embedding, answer, tables, user_query)
+
         return {"success": True, "answer": answer}
 
     except Exception as e:
         print(f"🔥 [ERROR] Exception occurred in /api/query: {e}")
         sys.stdout.flush()
         return JSONResponse(status_code=500, content={"success": False, "message": str(e)})
+    finally:
+        # Order requests and early returns never use the speculative pipeline
+        if info_task is not None:
+            if not info_task.done():
+                info_task.cancel()
+            elif not info_task.cancelled():
+                info_task.exception()   # retrieved, so a discarded failure is not logged as unhandled
 
 
 @router.post("/api/login")
@@ -3,10 +3,14 @@ from fastapi.middleware.cors import CORSMiddleware
 from email_api import router as email_router
 from login_api import router as login_router
 from chart_api import router as chart_router
-from vector_trigger import listen_to_new_orders
-from inventory_trigger import listen_to_inventory_updates
+from index_listener import listen_to_vector_store_changes
 from dealer_anlytics_api import router as dealer_analytics_router
+from metrics_api import router as metrics_router
 import asyncio
+import os
+import llm_client
+import log_writer
+from timing import ServerTimingMiddleware
 
 app = FastAPI()
 
@@ -17,17 +21,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# Per-stage latency breakdown of the query endpoints (Server-Timing header)
+app.add_middleware(ServerTimingMiddleware, paths=("/api/query",))
+
 
 # Include all routers
 app.include_router(email_router)
 app.include_router(chart_router)
 app.include_router(dealer_analytics_router)
 app.include_router(login_router)
+app.include_router(metrics_router)
 
 # Optional: Background tasks
-# @app.on_event("startup")
-# async def start_background_listeners():
-#     asyncio.create_task(listen_to_new_orders())
-#     asyncio.create_task(listen_to_inventory_updates())
+# The order / inventory listeners that embed and write vector_store run once, as their own
+# processes (python vector_trigger.py, python inventory_trigger.py). Each API worker mirrors
+# their writes into its vector index; in-place updates (inventory quantities) reach the index
+# no other way, the VECTOR_INDEX_REFRESH replay only sees new ids. ENABLE_DB_LISTENERS=false
+# turns the mirror off.
+@app.on_event("startup")
+async def start_background_listeners():
+    if os.getenv("ENABLE_DB_LISTENERS", "true").lower() == "true":
+        asyncio.create_task(listen_to_vector_store_changes())
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm_client.close_clients()
+
+
+@app.on_event("shutdown")
+async def flush_conversation_logs():
+    # Drain queued conversation_logs rows before the process exits
+    await asyncio.to_thread(log_writer.stop)
@@ -0,0 +1,37 @@
+import os
+import secrets
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+import log_writer
+import llm_cache
+import embedding_cache
+import answer_cache
+import intent_classifier
+import timing
+
+router = APIRouter()
+
+# Internal metrics. Callers must send METRICS_TOKEN as X-Metrics-Token; without a
+# configured token the endpoint only answers requests from this machine.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def authorized(request):
+    if METRICS_TOKEN:
+        return secrets.compare_digest(request.headers.get("X-Metrics-Token", ""), METRICS_TOKEN)
+    return request.client is not None and request.client.host in LOOPBACK_HOSTS
+
+
+@router.get("/internal/metrics")
+def get_metrics(request: Request):
+    if not authorized(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    return {
+        "conversation_log_writer": log_writer.stats(),
+        "llm_cache": llm_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "intent_classifier": intent_classifier.stats(),
+        "latency": timing.histograms(),
+    }
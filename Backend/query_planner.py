@@ -0,0 +1,157 @@
+import json
+import re
+from typing import Literal, Optional, Union
+from pydantic import BaseModel, ValidationError, field_validator
+import rag
+import llm_client
+import llm_cache
+import timing
+from rag import chat_endpoint, chat_headers, fuzzy_correct_entities, user_cache_scope
+
+# === Query planner ===
+# One chat call returns everything the pipeline used to ask for separately:
+# intent + order fields (extract_order_details), the metadata filter
+# (extract_metadata_with_llm) and the retrieval rewrite (rewrite_query_for_rag).
+# The plan is validated with pydantic; when the call or the validation fails,
+# plan_query returns None and callers fall back to the three original functions.
+
+METADATA_FILTER_FIELDS = (
+    "order_id", "dealer_id", "dealer_name", "sales_rep_id", "sales_rep_name", "product_id",
+    "product_name", "category", "warehouse_id", "warehouse_location", "claim_id",
+)
+
+
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+class OrderFields(BaseModel):
+    product_id: Optional[str] = None
+    product_name: Optional[str] = None
+    dealer_id: Optional[str] = None
+    dealer_name: Optional[str] = None
+    quantity: Optional[int] = None
+    warehouse_id: Optional[str] = None
+
+    @field_validator("product_id", "product_name", "dealer_id", "dealer_name", "warehouse_id", mode="before")
+    @classmethod
+    def ids_as_text(cls, value):
+        return _as_text(value)
+
+
+class QueryPlan(BaseModel):
+    intent: Literal["order", "info", "unknown"] = "unknown"
+    order: OrderFields = OrderFields()
+    metadata_filter: dict[str, Union[str, int]] = {}
+    rewrite: str = ""
+
+    @field_validator("metadata_filter", mode="before")
+    @classmethod
+    def known_fields_only(cls, value):
+        if not isinstance(value, dict):
+            return {}
+        return {k: v for k, v in value.items() if k in METADATA_FILTER_FIELDS and v not in (None, "")}
+
+    def order_details(self):
+        """The dict extract_order_details would have returned"""
+        details = {"intent": self.intent}
+        details.update(self.order.model_dump(exclude_none=True))
+        return details
+
+    def metadata(self):
+        """The value extract_metadata_with_llm would have returned"""
+        return dict(self.metadata_filter) if self.metadata_filter else None
+
+    def retrieval_query(self, user_query):
+        return self.rewrite.strip() or user_query
+
+
+PLANNER_PROMPT_VERSION = 1   # bump when PLANNER_PROMPT changes (invalidates cached plans)
+PLANNER_PROMPT = """
+You plan how to answer a message sent to a tyre manufacturer's assistant (products, inventory,
+orders, claims, dealers, sales reps, warehouses). Return ONLY a JSON object, no code block:
+
+{
+  "intent": "order" | "info",
+  "order": {"product_id", "product_name", "dealer_id", "dealer_name", "quantity", "warehouse_id"},
+  "metadata_filter": {...},
+  "rewrite": "..."
+}
+
+intent: "order" when the user wants to place / request an order, "info" for anything else
+(availability, product info, order or claim status, analytics).
+
+order: only for intent "order". Use product_id (exact SKU like "100/35R24 50P") or product_name
+("SpeedoCruze") and dealer_id or dealer_name ("Pooja Singh") as mentioned; quantity as a number.
+Omit what is not mentioned.
+
+metadata_filter: only fields clearly mentioned in the message, from: order_id, dealer_id,
+dealer_name, sales_rep_id, sales_rep_name, product_id, product_name, category, warehouse_id,
+warehouse_location, claim_id.
+
+rewrite: the message rewritten for semantic search: no conversational filler, tyre
+abbreviations expanded, relevant synonyms added, every identifier (IDs, part numbers,
+names) kept exactly.
+
+Examples:
+"Order 50 units of 100/35R24 for dealer 123" ->
+{"intent": "order", "order": {"dealer_id": "123", "product_id": "100/35R24", "quantity": 50}, "metadata_filter": {"dealer_id": "123", "product_id": "100/35R24"}, "rewrite": "order 50 units tyre 100/35R24 dealer 123"}
+"Check if 100/35R24 is in stock" ->
+{"intent": "info", "order": {}, "metadata_filter": {"product_id": "100/35R24"}, "rewrite": "stock availability inventory of tyre 100/35R24 across warehouses"}
+"""
+
+
+@llm_cache.cached("plan", PLANNER_PROMPT_VERSION, scope=user_cache_scope)
+def _request_plan(user_query):
+    """The validated plan as a plain dict (what llm_cache stores), or None"""
+    if not chat_endpoint:
+        return None
+    corrected_query = fuzzy_correct_entities(user_query)
+
+    user_context = ""
+    current_user = rag.get_current_user()
+    if current_user is not None and current_user.is_dealer():
+        user_context = (f"\nThe current user is a DEALER named {current_user.dealer_name} "
+                        f"with dealer_id '{current_user.dealer_id}'.")
+    elif current_user is not None and current_user.is_sales_rep():
+        user_context = (f"\nThe current user is a SALES REPRESENTATIVE named {current_user.sales_rep_name} "
+                        f"with sales_rep_id '{current_user.sales_rep_id}'.")
+
+    payload = {
+        "messages": [
+            {"role": "system", "content": PLANNER_PROMPT + user_context},
+            {"role": "user", "content": corrected_query}
+        ],
+        "temperature": 0,
+        "max_tokens": 400,
+        "top_p": 1
+    }
+    try:
+        response = llm_client.post(chat_endpoint, headers=chat_headers, json=payload)
+        if response.status_code != 200:
+            print(f"Query planner failed: {response.status_code}: {response.text}")
+            return None
+        content = response.json()["choices"][0]["message"]["content"].strip()
+        # Tolerate a ```json fence despite the instructions
+        content = re.sub(r"^```(?:json)?\s*|\s*```$", "", content)
+        return QueryPlan.model_validate(json.loads(content)).model_dump()
+    except (ValueError, KeyError, ValidationError) as e:
+        print(f"Query planner returned an invalid plan: {e}")
+        return None
+    except Exception as e:
+        print(f"Query planner error: {e}")
+        return None
+
+
+@timing.timed("plan")
+def plan_query(user_query):
+    """Single planner call; returns a QueryPlan, or None so callers use the individual extractors"""
+    data = _request_plan(user_query)
+    if data is None:
+        return None
+    plan = QueryPlan.model_validate(data)
+    print(f"DEBUG: Query plan: intent={plan.intent}, order={plan.order.model_dump(exclude_none=True)}, "
+          f"metadata_filter={plan.metadata_filter}, rewrite={plan.rewrite!r}")
+    return plan
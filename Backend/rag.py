@@ -1,7 +1,7 @@
 import os
 import re
 import json
-import requests
+import asyncio
 import numpy as np
 import psycopg2
 from supabase import create_client
@@ -12,9 +12,20 @@ from dotenv import load_dotenv
 from passlib.hash import bcrypt
 from datetime import datetime
 from collections import deque
-import requests
 import json
 import uuid
+import time
+import contextvars
+import numbers
+import llm_client
+import llm_cache
+import embedding_cache
+import answer_cache
+import conversation_history
+import log_writer
+import timing
+from vector_index import get_vector_index, fetch_descriptions
+from lexical_index import tokenize
 load_dotenv()
 # --- Set your database credentials here or in a .env file ---
 # os.environ["user"] =  os.getenv("user")
@@ -53,10 +64,16 @@ chat_headers  = {
     "Ocp-Apim-Subscription-Key": os.getenv("AZURE_CHAT_SUBSCRIPTION_KEY")
 }
 
+# Prompt versions of the cached LLM sub-calls (see llm_cache.py); bump one when its prompt changes
+LLM_PROMPT_VERSIONS = {"sql": 1, "metadata": 1, "order": 1, "rewrite": 1}
+
 
 ########################################################################
 #########################  USER SESSION ################################
-current_user = None
+# The logged-in user, per execution context: each /api/query request sets its own
+# UserSession and the tasks / asyncio.to_thread workers it starts inherit it, so
+# concurrent requests never read each other's user.
+_current_user = contextvars.ContextVar("current_user", default=None)
 current_session_id = None 
  
 class UserSession:
@@ -87,6 +104,23 @@ class UserSession:
     def get_dealer_filter(self):
         """Returns dealer_id for filtering if user is a dealer"""
         return self.dealer_id if self.is_dealer() else None
+    
+    def get_sales_rep_filter(self):
+        """Returns sales_rep_id for filtering if user is a sales representative"""
+        return self.sales_rep_id if self.is_sales_rep() else None
+ 
+def get_current_user():
+    return _current_user.get()
+ 
+def set_current_user(user_session):
+    _current_user.set(user_session)
+ 
+def user_cache_scope():
+    """Role scope (role, dealer_id, sales_rep_id) that role-aware LLM answers are cached under"""
+    current_user = get_current_user()
+    if current_user is None:
+        return (None, None, None)
+    return (current_user.role, current_user.dealer_id, current_user.sales_rep_id)
  
 def authenticate_user(username, password):
     try:
@@ -133,8 +167,6 @@ def login():
     """
     Handle user login
     """
-    global current_user
- 
     print("=== LOGIN REQUIRED ===")
     username = input("Username: ").strip()
     password = input("Password: ").strip()
@@ -142,7 +174,7 @@ def login():
     user_session = authenticate_user(username, password)
     
     if user_session:
-        current_user = user_session
+        set_current_user(user_session)
         print(f"Welcome {user_session.username}!")
         print(f"Role: {user_session.role}")
         if user_session.dealer_name:
@@ -162,19 +194,20 @@ def login():
     Handle user logout
     """
     #global current_user
-    if current_user:
-        print(f"Goodbye {current_user.username}!")
-        current_user = None
+    #if current_user:
+    #    print(f"Goodbye {current_user.username}!")
+    #    current_user = None
  
 def logout():
-    global current_user, current_session_id
-    current_user = None
+    global current_session_id
+    set_current_user(None)
     current_session_id = None  # ✅ Clear session ID on logout
     print("User logged out.")
 def check_authentication():
     """
     Check if user is authenticated
     """
+    current_user = get_current_user()
     return current_user is not None and current_user.is_authenticated
  
 #############################################################################
@@ -186,30 +219,19 @@ def check_authentication():
 
 
 def get_conversation_context(num_exchanges=5):
+    current_user = get_current_user()
     if current_user is None:
         print("[ERROR] get_conversation_context: current_user is None!")
         return ""
-    try:
-        result = supabase.table("conversation_logs") \
-            .select("user_query, ai_response") \
-            .eq("user_id", current_user.user_id) \
-            .order("query_timestamp", desc=True) \
-            .limit(num_exchanges) \
-            .execute()
- 
-        rows = result.data if hasattr(result, 'data') else []
-        if not rows:
-            return ""
- 
-        context = f"Last {num_exchanges} conversations from this user:\n"
-        for i, row in enumerate(reversed(rows), 1):
-            context += f"\nExchange {i}:\nUser: {row['user_query']}\nAssistant: {row['ai_response']}\n"
-        return context
- 
-    except Exception as e:
-        print("DEBUG: Failed to fetch context from Supabase:", e)
+    rows = conversation_history.recent_exchanges(supabase, current_user.user_id, num_exchanges)
+    if not rows:
         return ""
  
+    context = f"Last {num_exchanges} conversations from this user:\n"
+    for i, row in enumerate(rows, 1):
+        context += f"\nExchange {i}:\nUser: {row['user_query']}\nAssistant: {row['ai_response']}\n"
+    return context
+ 
 def is_follow_up_question(user_query):
     follow_up_signals = [
         'what about', 'and what', 'also show', 'more details', 'can you also',
@@ -220,59 +242,51 @@ def is_follow_up_question(user_query):
 def enhance_query_with_context(user_query):
     if not is_follow_up_question(user_query):
         return user_query
+    current_user = get_current_user()
     if current_user is None:
         print("[ERROR] enhance_query_with_context: current_user is None!")
         return user_query
-    try:
-        result = supabase.table("conversation_logs") \
-            .select("user_query, ai_response") \
-            .eq("user_id", current_user.user_id) \
-            .order("query_timestamp", desc=True) \
-            .limit(1) \
-            .execute()
- 
-        rows = result.data if hasattr(result, 'data') else []
-        if not rows:
-            return user_query
- 
-        last = rows[0]
-        return (
-            f"Previous context: {last['user_query']}\n"
-            f"Previous response: {last['ai_response']}\n\n"
-            f"Follow-up question: {user_query}\n\n"
-            f"Please answer the follow-up considering the previous context."
-        )
- 
-    except Exception as e:
-        print("DEBUG: Failed to enhance query with context:", e)
+    rows = conversation_history.recent_exchanges(supabase, current_user.user_id, 1)
+    if not rows:
         return user_query
  
-def save_to_supabase(user_query, response):
-    if current_user is None:
+    last = rows[-1]
+    return (
+        f"Previous context: {last['user_query']}\n"
+        f"Previous response: {last['ai_response']}\n\n"
+        f"Follow-up question: {user_query}\n\n"
+        f"Please answer the follow-up considering the previous context."
+    )
+ 
+def save_to_supabase(user_query, response, user=None):
+    """Queue the exchange for conversation_logs (written in batches by log_writer)"""
+    user = user or get_current_user()
+    if user is None:
         print("[ERROR] save_to_supabase: current_user is None!")
         return
-    try:
-        log_data = {
-            'user_id': current_user.user_id,
-            'dealer_id': current_user.dealer_id,
-            'sales_rep_id': current_user.sales_rep_id,
-            'user_query': user_query,
-            'ai_response': response,
-            'session_id': current_session_id,
-            'query_timestamp': datetime.now().isoformat(),
-            'metadata': {}  # Add any relevant metadata if needed
-        }
-        result = supabase.table("conversation_logs").insert(log_data).execute()
-        print(f"DEBUG: Supabase log result: {result}")
-    except Exception as e:
-        print(f"Error saving to Supabase: {e}")
+    log_data = {
+        'user_id': user.user_id,
+        'dealer_id': user.dealer_id,
+        'sales_rep_id': user.sales_rep_id,
+        'user_query': user_query,
+        'ai_response': response,
+        'session_id': current_session_id,
+        'query_timestamp': datetime.now().isoformat(),
+        'metadata': {}  # Add any relevant metadata if needed
+    }
+    conversation_history.append(user.user_id, user_query, response)
+    if not log_writer.get_log_writer(supabase).enqueue(log_data):
+        print("DEBUG: Conversation log queue is full, exchange not logged")
  
 #############################################################################
 ########################  FUZZY  ################################
 DEALER_CACHE = {}
 PRODUCT_CACHE = {}
+PRODUCT_NAME_CACHE = {}
 WAREHOUSE_CACHE = {}
 SALES_REP_CACHE = {}
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "3600"))   # seconds between reloads (ensure_entity_caches)
+_entities_loaded_at = None
  
 def normalize_text(text):
     """Normalize text for better matching"""
@@ -305,7 +319,7 @@ def fuzzy_match_string(query_string, candidates, threshold=70):
  
 def get_database_entities():
     """Cache database entities for fuzzy matching"""
-    global DEALER_CACHE, PRODUCT_CACHE, WAREHOUSE_CACHE
+    global DEALER_CACHE, PRODUCT_CACHE, PRODUCT_NAME_CACHE, WAREHOUSE_CACHE, SALES_REP_CACHE
     
     try:
         conn = psycopg2.connect(
@@ -330,6 +344,10 @@ def get_database_entities():
         cur.execute("SELECT DISTINCT product_id FROM product WHERE product_id IS NOT NULL")
         products = [row[0] for row in cur.fetchall()]
         PRODUCT_CACHE = {normalize_text(p): p for p in products}
+
+        cur.execute("SELECT DISTINCT product_name FROM product WHERE product_name IS NOT NULL")
+        product_names = [row[0] for row in cur.fetchall()]
+        PRODUCT_NAME_CACHE = {normalize_text(p): p for p in product_names}
         
         # Get warehouses
         cur.execute("SELECT DISTINCT location FROM warehouse WHERE location IS NOT NULL")
@@ -343,6 +361,14 @@ def get_database_entities():
  
     except Exception as e:
         print(f"DEBUG: Error caching entities: {e}")
+
+def ensure_entity_caches():
+    """Load the entity caches on first use and again once ENTITY_CACHE_TTL has passed"""
+    global _entities_loaded_at
+    now = time.time()
+    if _entities_loaded_at is None or now - _entities_loaded_at > ENTITY_CACHE_TTL:
+        _entities_loaded_at = now   # also after a failure, so a down database is not retried per query
+        get_database_entities()
  
 def fuzzy_correct_entities(text):
     """
@@ -419,29 +445,21 @@ def fuzzy_correct_entities(text):
  
 #     return base_query
  
+@timing.timed("sql_generation")
+@llm_cache.cached("sql", LLM_PROMPT_VERSIONS["sql"], scope=user_cache_scope,
+                  skip=is_follow_up_question, failed=lambda sql: not sql)
 def get_llm_sql(user_query):
     """Generate SQL with correct role-based access control logic + recent history"""
+    current_user = get_current_user()
     if current_user is None:
         print("[ERROR] get_llm_sql: current_user is None!")
         return ""
     corrected_query = fuzzy_correct_entities(user_query)
  
-    # Fetch last 3 user logs for context
-    try:
-        result = supabase.table("conversation_logs") \
-            .select("user_query, ai_response") \
-            .eq("user_id", current_user.user_id) \
-            .order("query_timestamp", desc=True) \
-            .limit(3) \
-            .execute()
- 
-        rows = result.data if hasattr(result, 'data') else []
-        history_context = ""
-        for i, row in enumerate(reversed(rows), 1):
-            history_context += f"\nExchange {i}:\nUser: {row['user_query']}\nAssistant: {row['ai_response']}\n"
-    except Exception as e:
-        print("DEBUG: Failed to fetch history logs for SQL context:", e)
-        history_context = ""
+    # Last 3 exchanges of this user for context
+    history_context = ""
+    for i, row in enumerate(conversation_history.recent_exchanges(supabase, current_user.user_id, 3), 1):
+        history_context += f"\nExchange {i}:\nUser: {row['user_query']}\nAssistant: {row['ai_response']}\n"
 
     template_knowledge = """
 You can directly use one of these templates if it matches the intent. Substitute variables if needed:
@@ -568,7 +586,7 @@ IMPORTANT ROLE-BASED ACCESS CONTROL:
     if not isinstance(chat_endpoint, str):
         raise ValueError("Chat endpoint URL is not set or is invalid.")
 
-    response = requests.post(chat_endpoint, headers=chat_headers, json=payload)
+    response = llm_client.post(chat_endpoint, headers=chat_headers, json=payload)
     if response.status_code == 200:
         sql = response.json()["choices"][0]["message"]["content"].strip()
         return sql
@@ -581,7 +599,9 @@ def clean_sql_output(raw_sql):
     cleaned = re.sub(r"```(?:sql)?", "", raw_sql, flags=re.IGNORECASE).strip()
     return cleaned
  
-def try_select_sql(sql):
+@timing.timed("sql_execution")
+def try_select_sql(sql, params=None):
+    """Run a SELECT; params are bound by psycopg2 (%s placeholders), as sql_templates renders them"""
     sql = sql.strip()
     if not sql.lower().startswith("select"):
         return None, "Only SELECT statements are allowed for safety."
@@ -594,7 +614,7 @@ def try_select_sql(sql):
             port=os.getenv("port")
         )
         cur = conn.cursor()
-        cur.execute(sql)
+        cur.execute(sql, params)
         if cur.description is None:
             cur.close()
             conn.close()
@@ -609,25 +629,95 @@ def try_select_sql(sql):
         return None, str(e)
     
  
-def sql_result_to_context(sql_result):
+SQL_CONTEXT_TOKEN_BUDGET = int(os.getenv("SQL_CONTEXT_TOKEN_BUDGET", "1500"))
+ 
+def estimate_tokens(text):
+    """Rough prompt size: about 4 characters per token for English / ID-heavy text"""
+    return (len(text) + 3) // 4 if text else 0
+ 
+def _sql_cell(value):
+    if value is None:
+        return ""
+    return str(value).replace("|", "/").replace("\n", " ")
+ 
+def _is_summable(column, values):
+    """Numeric columns worth totalling (ids and flags are not)"""
+    if column.lower() == "id" or column.lower().endswith("_id"):
+        return False
+    present = [v for v in values if v is not None]
+    return bool(present) and all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in present)
+ 
+def sql_result_to_context(sql_result, token_budget=None):
+    """
+    Render SQL rows as one header line plus one pipe-separated line per row.
+    Results over the token budget are summarised instead: row count, totals of the
+    numeric columns, then as many top rows (by the first such column) as fit, and
+    how many rows were omitted.
+    """
     if not sql_result:
         return "No results found."
-    rows_as_strings = []
+    if token_budget is None:
+        token_budget = SQL_CONTEXT_TOKEN_BUDGET
+    
+    columns = []
     for row in sql_result:
-        # Format every row: each key-value on its own line
-        row_str = '\n'.join(f"{k}: {v}" for k, v in row.items() if v is not None)
-        rows_as_strings.append(row_str)
-    return "\n\n".join(rows_as_strings)
+        for key in row:
+            if key not in columns:
+                columns.append(key)
+    # Columns that are empty in every row add nothing
+    columns = [c for c in columns if any(row.get(c) is not None for row in sql_result)]
+    header = " | ".join(columns)
+    lines = [" | ".join(_sql_cell(row.get(c)) for c in columns) for row in sql_result]
+    table = f"{len(sql_result)} rows\n{header}\n" + "\n".join(lines)
+    if estimate_tokens(table) <= token_budget:
+        return table
+    
+    summable = [c for c in columns if _is_summable(c, [row.get(c) for row in sql_result])]
+    summary = [f"{len(sql_result)} rows (summarised to fit the prompt)"]
+    if summable:
+        totals = ", ".join(f"{c}={sum(row.get(c) or 0 for row in sql_result)}" for c in summable)
+        summary.append(f"Totals: {totals}")
+        sort_column = summable[0]
+        ordered = sorted(range(len(sql_result)), key=lambda i: sql_result[i].get(sort_column) or 0, reverse=True)
+        summary.append(f"Top rows by {sort_column}:")
+    else:
+        ordered = range(len(sql_result))
+        summary.append("First rows:")
+    summary.append(header)
+    
+    used_tokens = estimate_tokens("\n".join(summary)) + 16   # room for the omitted line
+    shown = 0
+    for i in ordered:
+        tokens = estimate_tokens(lines[i]) + 1
+        if used_tokens + tokens > token_budget:
+            break
+        summary.append(lines[i])
+        used_tokens += tokens
+        shown += 1
+    summary.append(f"... {len(sql_result) - shown} rows omitted")
+    print(f"DEBUG: SQL context summarised: {shown}/{len(sql_result)} rows shown, "
+          f"~{estimate_tokens(table)} -> ~{used_tokens} tokens")
+    return "\n".join(summary)
  
     
  
 ############################################################################################
 ###################### RAG ############################################################
  
+@timing.timed("rewrite")
+@llm_cache.cached("rewrite", LLM_PROMPT_VERSIONS["rewrite"])
 def rewrite_query_for_rag(user_query):
     """
-    Enhanced query rewriting with fuzzy correction
+    Enhanced query rewriting with fuzzy correction.
+    Skipped when the query's identifiers already resolve to a handful of rows in the
+    lexical index; the hybrid search will find those rows from the raw query.
     """
+    identifier_rows = get_vector_index(supabase).identifier_lookup(user_query)
+    if identifier_rows:
+        print(f"DEBUG: Identifier match on {len(identifier_rows)} rows, skipping query rewrite")
+        llm_cache.dont_store()   # depends on the index contents, not just the query
+        return user_query
+    
     corrected_query = fuzzy_correct_entities(user_query)
     
     system_prompt = (
@@ -662,7 +752,7 @@ def rewrite_query_for_rag(user_query):
     try:
         if chat_endpoint is None:
             raise Exception("Chat endpoint is not set (AZURE_OPENAI_URL missing)")
-        response = requests.post(chat_endpoint, headers=chat_headers, json=payload)
+        response = llm_client.post(chat_endpoint, headers=chat_headers, json=payload)
         if response.status_code == 200:
             rewritten_query = response.json()["choices"][0]["message"]["content"].strip()
             print(f"DEBUG: Original query: {user_query}")
@@ -671,9 +761,11 @@ def rewrite_query_for_rag(user_query):
             return rewritten_query
         else:
             print(f"Query rewriting failed: {response.status_code}: {response.text}")
+            llm_cache.dont_store()
             return corrected_query
     except Exception as e:
         print(f"Query rewriting error: {e}")
+        llm_cache.dont_store()
         return corrected_query
  
 def preprocess_query(query):
@@ -682,13 +774,19 @@ def preprocess_query(query):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
  
+@timing.timed("embedding")
 def get_embedding(text):
     if embedding_endpoint is None:
         raise Exception("Embedding endpoint is not set (AZURE_OPENAI_URL missing)")
+    cached = embedding_cache.lookup(text)
+    if cached is not None:
+        return cached
     payload = {"input": text}
-    response = requests.post(embedding_endpoint, headers=embedding_headers, json=payload)
+    response = llm_client.post(embedding_endpoint, headers=embedding_headers, json=payload)
     if response.status_code == 200:
-        return response.json()["data"][0]["embedding"]
+        embedding = response.json()["data"][0]["embedding"]
+        embedding_cache.store(text, embedding)
+        return embedding
     else:
         raise Exception(f"Embedding API error {response.status_code}: {response.text}")
  
@@ -698,10 +796,13 @@ def cosine_similarity(vec1, vec2):
     if np.linalg.norm(vec1) == 0 or np.linalg.norm(vec2) == 0:
         return 0.0
     return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
+@timing.timed("metadata")
+@llm_cache.cached("metadata", LLM_PROMPT_VERSIONS["metadata"], scope=user_cache_scope)
 def extract_metadata_with_llm(user_query):
     """
     Enhanced metadata extraction with role-based context and updated fields
     """
+    current_user = get_current_user()
     if current_user is None:
         print("[ERROR] extract_metadata_with_llm: current_user is None!")
         return None
@@ -759,7 +860,7 @@ def extract_metadata_with_llm(user_query):
         return None
 
     try:
-        response = requests.post(chat_endpoint, headers=chat_headers, json=payload)
+        response = llm_client.post(chat_endpoint, headers=chat_headers, json=payload)
     except Exception as e:
         print(f"[ERROR] extract_metadata_with_llm: Exception during POST request: {e}")
         return None
@@ -784,6 +885,7 @@ def enhanced_metadata_filter_matching(metadata_filter, row_metadata):
         return 0
     
     # Add role-based filtering to metadata
+    current_user = get_current_user()
     if current_user and current_user.is_dealer():
         # Check if metadata contains dealer-specific information
         if 'dealer_id' in row_metadata:
@@ -815,55 +917,130 @@ def enhanced_metadata_filter_matching(metadata_filter, row_metadata):
     
     return match_score / total_filters if total_filters > 0 else 0
  
-def vector_store_similarity_search(query_embedding, top_k=10, metadata_filter=None, similarity_threshold=0.1):
+# vector_store.table_join values, grouped by the domain a question is about
+TABLE_JOIN_DOMAINS = {
+    "claims": ["claim+product+dealer+sales_reps"],
+    "orders": ["orders+product+dealer+sales_reps+warehouse", "orders"],
+    "inventory": ["inventory+product+warehouse"],
+    "products": ["product"],
+}
+DOMAIN_KEYWORDS = {
+    "claims": ["claim", "warranty", "complaint", "defect", "reimburse"],
+    "orders": ["order", "purchase", "bought", "invoice"],
+    "inventory": ["stock", "inventory", "available", "availability", "warehouse", "units left"],
+    "products": ["similar", "specification", "specs", "aspect ratio", "section width", "rim diameter", "construction type"],
+}
+DOMAIN_METADATA_KEYS = {
+    "claim_id": "claims",
+    "order_id": "orders",
+    "warehouse_id": "inventory",
+    "warehouse_location": "inventory",
+}
+ 
+def route_table_joins(user_query, metadata_filter=None):
     """
-    Enhanced vector similarity search with role-based access control
+    Pick the vector_store sub-indexes (table_join values) a question is about, from the
+    extracted metadata and intent keywords. Returns None when nothing points at a
+    domain, meaning search everything.
     """
-    response = supabase.table("vector_store").select("*").execute()
-    rows = response.data
-    if not rows:
+    domains = set()
+    for key, domain in DOMAIN_METADATA_KEYS.items():
+        if metadata_filter and metadata_filter.get(key):
+            domains.add(domain)
+    query_lower = (user_query or "").lower()
+    for domain, keywords in DOMAIN_KEYWORDS.items():
+        if any(re.search(r'\b' + re.escape(keyword), query_lower) for keyword in keywords):
+            domains.add(domain)
+    if not domains:
+        return None
+    table_joins = [table_join for domain in sorted(domains) for table_join in TABLE_JOIN_DOMAINS[domain]]
+    print(f"DEBUG: Routed vector search to {sorted(domains)}")
+    return table_joins
+ 
+@timing.timed("vector_search")
+def vector_store_similarity_search(query_embedding, top_k=10, metadata_filter=None, similarity_threshold=0.1, table_joins=None, query_text=None):
+    """
+    Enhanced vector similarity search with role-based access control.
+    Scores against the resident vector index instead of re-fetching vector_store per query,
+    limited to the table_join sub-indexes from route_table_joins when given.
+    With query_text, exact identifiers are matched through the BM25 index and fused in.
+    """
+    index = get_vector_index(supabase)
+    if index.size == 0:
         return []
     
-    # Enhanced metadata filtering with role-based access control
-    if metadata_filter:
-        scored_rows = []
-        for row in rows:
-            try:
-                meta = row.get("metadata")
-                if isinstance(meta, str):
-                    meta = json.loads(meta)
-                
-                match_score = enhanced_metadata_filter_matching(metadata_filter, meta)
-                if match_score > 0:
-                    scored_rows.append((match_score, row))
-            except Exception:
-                continue
-        
-        scored_rows.sort(reverse=True, key=lambda x: x[0])
-        if scored_rows:
-            rows = [row for score, row in scored_rows if score >= 0.3]
-        else:
-            rows = []
+    # Role-based access control is structural: dealers and sales reps only scan their own
+    # shard plus the shared product/inventory rows; admins scan everything.
+    # Metadata filtering goes through the index's inverted metadata postings.
+    current_user = get_current_user()
+    dealer_id = current_user.get_dealer_filter() if current_user else None
+    sales_rep_id = current_user.get_sales_rep_filter() if current_user else None
     
     # Vector similarity with threshold filtering
-    similarities = []
-    for row in rows:
-        try:
-            row_embedding = json.loads(row["embedding"])
-            sim = cosine_similarity(query_embedding, row_embedding)
-            if sim >= similarity_threshold:
-                similarities.append((sim, row))
-        except Exception:
-            continue
+    similarities = index.search(
+        query_embedding, top_k, similarity_threshold,
+        metadata_filter=metadata_filter,
+        dealer_id=dealer_id,
+        sales_rep_id=sales_rep_id,
+        table_joins=table_joins,
+        query_text=query_text
+    )
+    if table_joins and not similarities:
+        print("DEBUG: No results in routed sub-indexes, falling back to all of vector_store")
+        similarities = index.search(
+            query_embedding, top_k, similarity_threshold,
+            metadata_filter=metadata_filter,
+            dealer_id=dealer_id,
+            sales_rep_id=sales_rep_id,
+            query_text=query_text
+        )
+    # The index holds no descriptions; fetch them for the final top-k only
+    return fetch_descriptions(supabase, [row for sim, row in similarities])
+
+def vector_store_similarity_search_batch(query_embeddings, top_k=10, metadata_filters=None, similarity_threshold=0.1, table_joins=None):
+    """
+    Batched vector_store_similarity_search for several query embeddings (speculative rewrites,
+    multi-part questions, offline evaluation). metadata_filters and table_joins are optional
+    per-query lists. Returns one list of rows per query.
+    """
+    index = get_vector_index(supabase)
+    if index.size == 0 or len(query_embeddings) == 0:
+        return [[] for _ in query_embeddings]
+    
+    current_user = get_current_user()
+    dealer_id = current_user.get_dealer_filter() if current_user else None
+    sales_rep_id = current_user.get_sales_rep_filter() if current_user else None
+    n_queries = len(query_embeddings)
+    metadata_filters = metadata_filters or [None] * n_queries
+    table_joins = table_joins or [None] * n_queries
+    
+    def filters(routed):
+        return [{
+            "metadata_filter": metadata_filters[i],
+            "dealer_id": dealer_id,
+            "sales_rep_id": sales_rep_id,
+            "table_joins": table_joins[i] if routed else None
+        } for i in range(n_queries)]
     
-    similarities.sort(reverse=True, key=lambda x: x[0])
-    results = [row for sim, row in similarities[:top_k]]
+    similarities = index.search_batch(query_embeddings, top_k, similarity_threshold, filters(True))
     
-    if similarities:
-        print(f"DEBUG: Found {len(similarities)} results above threshold {similarity_threshold}")
-        print(f"DEBUG: Top similarity scores: {[round(sim, 3) for sim, _ in similarities[:5]]}")
+    # Same fallback as the single-query search: routed queries with no hits go again unrouted
+    retry = [i for i in range(n_queries) if table_joins[i] and not similarities[i]]
+    if retry:
+        print(f"DEBUG: No results in routed sub-indexes for {len(retry)} queries, retrying over all of vector_store")
+        unrouted = filters(False)
+        retried = index.search_batch([query_embeddings[i] for i in retry], top_k, similarity_threshold,
+                                     [unrouted[i] for i in retry])
+        for i, result in zip(retry, retried):
+            similarities[i] = result
     
-    return results
+    # One description fetch for every query's top-k
+    rows = fetch_descriptions(supabase, [row for result in similarities for sim, row in result])
+    batched, offset = [], 0
+    for result in similarities:
+        batched.append(rows[offset:offset + len(result)])
+        offset += len(result)
+    return batched
  
 # def rows_to_context(rows):
 #     context = ""
@@ -874,27 +1051,90 @@ def vector_store_similarity_search(query_embedding, top_k=10, metadata_filter=No
 #                 context += f"{key}: {value}\n"
 #     return context.strip()
  
-def vector_rows_to_context(rows):
-    context = ""
-    for idx, row in enumerate(rows, 1):
-        context += f"\nVector Row {idx}:\n"
-        for key, value in row.items():
-            if key != "embedding":
-                context += f"{key}: {value}\n"
-    return context.strip()
+# --- Prompt budget for the retrieved rows ---
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1200"))
+NEAR_DUPLICATE_SIMILARITY = 0.9   # token-set Jaccard above which a row repeats a better one
+ 
+def metadata_value_stated(value, description_lower):
+    """
+    Whether the description already states a metadata value: a whole-word match, and only
+    for values of 4+ characters; short ones (quantity 5, W1) are always kept.
+    """
+    value = str(value).lower().strip()
+    if len(value) < 4:
+        return False
+    return re.search(r"(?<![\w/.\-])" + re.escape(value) + r"(?![\w/\-])", description_lower) is not None
+
+def vector_row_to_text(idx, row):
+    """
+    One retrieved row as prompt text: the description, plus only the metadata
+    fields whose values the description does not already state.
+    """
+    description = str(row.get("description") or "").strip()
+    description_lower = description.lower()
+    metadata = row.get("metadata")
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except (TypeError, ValueError):
+            metadata = {}
+    extra = [
+        f"{key}: {value}" for key, value in (metadata or {}).items()
+        if value not in (None, "") and not metadata_value_stated(value, description_lower)
+    ]
+    text = f"Vector Row {idx} ({row.get('table_join', 'unknown')}):\n{description}"
+    if extra:
+        text += "\n" + ", ".join(extra)
+    return text
+ 
+def vector_rows_to_context(rows, token_budget=None):
+    """
+    Build the RAG part of the final prompt within a token budget.
+    Rows arrive best first from vector_store_similarity_search; near-duplicates of a
+    better row are dropped, and rows that do not fit are cut from the bottom (the
+    last one that partly fits is truncated).
+    """
+    if token_budget is None:
+        token_budget = RAG_CONTEXT_TOKEN_BUDGET
+    raw_tokens = estimate_tokens("".join(
+        f"{key}: {value}\n" for row in rows for key, value in row.items() if key != "embedding"
+    ))
+    
+    blocks, kept_terms = [], []
+    used_tokens = duplicates = over_budget = 0
+    for row in rows:
+        terms = set(tokenize(row.get("description") or ""))
+        if terms and any(len(terms & seen) / len(terms | seen) >= NEAR_DUPLICATE_SIMILARITY for seen in kept_terms):
+            duplicates += 1
+            continue
+        text = vector_row_to_text(len(blocks) + 1, row)
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            remaining = token_budget - used_tokens
+            if remaining >= 32 and not over_budget:
+                blocks.append(text[:remaining * 4].rstrip() + " ...")
+                used_tokens += remaining
+            over_budget += 1
+            continue
+        blocks.append(text)
+        kept_terms.append(terms)
+        used_tokens += tokens
+    
+    print(f"DEBUG: RAG context ~{used_tokens} tokens for {len(blocks)}/{len(rows)} rows "
+          f"(saved ~{max(0, raw_tokens - used_tokens)} tokens; {duplicates} near-duplicates, {over_budget} over budget)")
+    return "\n\n".join(blocks)
  
 ###########################################################################################
 ####################### FINAL RESPONSE #####################################################
 
 
 
-def get_llm_final_response(sql_context, rag_context, user_query):
-    if current_user is None:
-        print("[ERROR] get_llm_final_response: current_user is None!")
-        return "Sorry, I can't assist with that. (No user context)"
+def build_final_response_payload(sql_context, rag_context, user_query):
+    """Chat payload for the final answer; shared by the blocking and streaming variants"""
     enhanced_query = enhance_query_with_context(user_query)
     history_context = get_conversation_context(2)
  
+    current_user = get_current_user()
     user_context = ""
     if current_user:
         user_context = (
@@ -973,7 +1213,7 @@ def get_llm_final_response(sql_context, rag_context, user_query):
         {"role": "user", "content": user_message.strip()}
     ]
  
-    payload = {
+    return {
         "messages": messages,
         "temperature": 0.0,
         "max_tokens": 2000,
@@ -981,19 +1221,69 @@ def get_llm_final_response(sql_context, rag_context, user_query):
         "frequency_penalty": 0,
         "presence_penalty": 0
     }
+ 
+@timing.timed("final_answer")
+def get_llm_final_response(sql_context, rag_context, user_query):
+    current_user = get_current_user()
+    if current_user is None:
+        print("[ERROR] get_llm_final_response: current_user is None!")
+        return "Sorry, I can't assist with that. (No user context)"
+    payload = build_final_response_payload(sql_context, rag_context, user_query)
 
     if chat_endpoint is None:
         print("DEBUG: Chat API endpoint is not set.")
         return "Sorry, I can't assist with that."
 
     try:
-        response = requests.post(str(chat_endpoint), headers=chat_headers, json=payload)
+        response = llm_client.post(str(chat_endpoint), headers=chat_headers, json=payload)
         response.raise_for_status()
         return response.json()["choices"][0]["message"]["content"]
     except Exception as e:
         print("DEBUG: Chat API failed:", e)
         return "Sorry, I can't assist with that."
  
+async def stream_llm_final_response(sql_context, rag_context, user_query):
+    """
+    Streaming get_llm_final_response: an async generator of answer text deltas, read from
+    the chat-completion SSE stream ("stream": true). Yields the usual apology when the call
+    fails before any text; a failure after that is raised, so the partial answer is never
+    taken for a complete one.
+    """
+    current_user = get_current_user()
+    if current_user is None:
+        print("[ERROR] stream_llm_final_response: current_user is None!")
+        yield "Sorry, I can't assist with that. (No user context)"
+        return
+    if chat_endpoint is None:
+        print("DEBUG: Chat API endpoint is not set.")
+        yield "Sorry, I can't assist with that."
+        return
+    payload = await asyncio.to_thread(build_final_response_payload, sql_context, rag_context, user_query)
+    payload["stream"] = True
+    # Azure only reports token usage for a stream (in a final, choice-less chunk) when asked
+    payload["stream_options"] = {"include_usage": True}
+    
+    streamed_any = False
+    try:
+        async for line in llm_client.astream_lines(chat_endpoint, headers=chat_headers, json=payload):
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            timing.record_usage(chunk.get("usage"))
+            for choice in chunk.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    streamed_any = True
+                    yield delta
+    except Exception as e:
+        print("DEBUG: Chat API stream failed:", e)
+        if streamed_any:
+            raise
+        yield "Sorry, I can't assist with that."
+ 
  
 ###################################################################################################
 ##############################  ORDERS ############################################################
@@ -1003,6 +1293,7 @@ def place_order(dealer_id, product_id, quantity, warehouse_id=None):
     Place an order - only for sales representatives.
     Deducts stock from warehouse and records the order.
     """
+    current_user = get_current_user()
     if not current_user or not current_user.is_sales_rep():
         return {"success": False, "message": "Only sales representatives can place orders."}
     
@@ -1099,6 +1390,7 @@ def place_order(dealer_id, product_id, quantity, warehouse_id=None):
  
         # 7. Commit
         conn.commit()
+        answer_cache.bump("orders", "inventory", "sales_reps")
  
         return {
             "success": True,
@@ -1185,6 +1477,9 @@ def check_stock_availability(product_id, required_quantity=1):
 
 
 
+@timing.timed("intent")
+@llm_cache.cached("order", LLM_PROMPT_VERSIONS["order"],
+                  failed=lambda details: not isinstance(details, dict) or details.get("intent") == "unknown")
 def extract_order_details(user_query):
     """
     Extract order intent and details using LLM.
@@ -1248,7 +1543,7 @@ Examples:
     try:
         if chat_endpoint is None:
             raise ValueError("chat_endpoint is not set")
-        response = requests.post(str(chat_endpoint), headers=chat_headers, json=payload)
+        response = llm_client.post(str(chat_endpoint), headers=chat_headers, json=payload)
         print("DEBUG: LLM API status:", response.status_code)
         print("DEBUG: LLM API response:", response.text)
         if response.status_code == 200:
@@ -1414,6 +1709,7 @@ def main():
     print("Initializing entity cache...")
     get_database_entities()
  
+    current_user = get_current_user()
     if current_user is not None:
         print(f"\nWelcome, {current_user.username}!")
         if current_user.is_dealer():
@@ -1489,7 +1785,7 @@ def main():
  
                     print(f"shivam : {response}")
  
-                    #save_to_supabase(user_query, response)
+                    save_to_supabase(user_query, response)
                     continue
  
                 elif intent == "info":
@@ -1499,7 +1795,7 @@ def main():
                     response = "❌ Could not understand your intent. Please try rephrasing."
                     print(f"shivam : {response}")
  
-                    #save_to_supabase(user_query, response)
+                    save_to_supabase(user_query, response)
                     continue
  
             # 🧠 SQL + RAG for Dealer, Admin, or Sales Rep with info intent
@@ -1525,7 +1821,9 @@ def main():
                     query_embedding,
                     top_k=10,
                     metadata_filter=metadata_filter,
-                    similarity_threshold=0.08
+                    similarity_threshold=0.08,
+                    table_joins=route_table_joins(user_query, metadata_filter),
+                    query_text=user_query
                 )
  
                 rag_context = vector_rows_to_context(vector_rows) if vector_rows else "No relevant vector context found."
@@ -1560,7 +1858,7 @@ def main():
 
                 print(f"shivam : {format_final_response(answer)}")
 
-                #save_to_supabase(user_query, answer)
+                save_to_supabase(user_query, answer)
  
         except Exception as e:
             print("shivam : Sorry, I can't assist with that.")
@@ -1574,6 +1872,7 @@ def main():
 if __name__ == "__main__":
     main()
  
+@timing.timed("user_lookup")
 def get_user_by_username(username):
     """
     Look up a user by username and return a UserSession object (no password check).
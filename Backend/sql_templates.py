@@ -0,0 +1,182 @@
+import re
+import rag
+import timing
+from rag import normalize_text, fuzzy_match_string, ensure_entity_caches
+from lexical_index import tokenize
+
+# === Local router for the built-in SQL templates ===
+# get_llm_sql's prompt carries four canonical queries (TEMPLATE_1-4). Questions that are
+# literally one of them are matched here, from intent keywords, entity slots (the rag entity
+# caches) and the UserSession, and rendered with %s parameters for try_select_sql, so they
+# skip the SQL-generation call. A question only matches when every term in it is either
+# template vocabulary or a resolved slot; anything more specific goes to the LLM.
+
+STOCK_PATTERN = re.compile(r"\b(stocks?|inventory|availab(le|ility))\b", re.IGNORECASE)
+ALL_WAREHOUSES_PATTERN = re.compile(r"\b(all|every|each|across)\b.*\bwarehouses?\b|\bwarehouse[- ]wise\b", re.IGNORECASE)
+SIMILAR_PATTERN = re.compile(r"\b(similar|alternatives?|like)\b", re.IGNORECASE)
+ORDERS_PATTERN = re.compile(r"\b(last|recent|latest|previous)\b.*\borders\b|\border history\b", re.IGNORECASE)
+SALES_REP_PATTERN = re.compile(r"\bsales\s*(reps?|representatives?|person|persons)\b", re.IGNORECASE)
+EACH_DEALER_PATTERN = re.compile(r"\b(each|every|all)\b.*\bdealers?\b", re.IGNORECASE)
+MY_PATTERN = re.compile(r"\b(my|our)\b", re.IGNORECASE)
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+                "nine": 9, "ten": 10, "twenty": 20}
+MAX_ORDER_ROWS = 50   # larger "last N orders" requests go to the LLM SQL path instead of being cut short
+
+TEMPLATE_VOCABULARY = {
+    "TEMPLATE_1": {"stock", "stocks", "inventory", "available", "availability", "level", "levels", "current",
+                   "every", "each", "across", "warehouse", "warehouses", "wise", "product", "products",
+                   "quantity", "quantities", "how", "much", "many", "units", "left", "check", "see", "do", "we",
+                   "there", "tyre", "tyres", "tire", "tires", "our", "everything", "overall", "entire"},
+    "TEMPLATE_2": {"similar", "product", "products", "tyre", "tyres", "tire", "tires", "like", "alternative",
+                   "alternatives", "other", "same", "category", "than", "suggest", "recommend", "some",
+                   "any", "are", "there", "find"},
+    "TEMPLATE_3": {"last", "recent", "latest", "previous", "orders", "order", "history", "placed", "our",
+                   "most", "few", "see", "view"} | set(NUMBER_WORDS),
+    "TEMPLATE_4": {"sales", "rep", "reps", "representative", "representatives", "person", "persons", "assigned",
+                   "each", "every", "dealer", "dealers", "who", "mapping", "our", "handles", "handling",
+                   "manages", "manager", "contact", "name", "names"},
+}
+
+TEMPLATE_1_SQL = """
+SELECT p.product_id, p.product_name, w.location AS warehouse_location, i.quantity
+FROM inventory i
+JOIN product p ON i.product_id = p.product_id
+JOIN warehouse w ON i.warehouse_id = w.warehouse_id
+{where}ORDER BY p.product_id, w.location;
+"""
+
+TEMPLATE_2_SQL = """
+SELECT p2.product_name
+FROM product p1
+JOIN product p2 ON p1.category = p2.category
+WHERE p1.product_name = %s AND p2.product_name <> %s
+LIMIT 5;
+"""
+
+TEMPLATE_3_SQL = """
+SELECT o.dealer_id, o.order_id, o.order_date, o.product_id, p.product_name, o.quantity, o.total_cost
+FROM orders o
+JOIN product p ON o.product_id = p.product_id
+{where}ORDER BY o.order_date DESC
+LIMIT %s;
+"""
+
+TEMPLATE_4_SQL = """
+SELECT d.dealer_id, d.name AS dealer_name, s.name AS sales_rep_name
+FROM dealer d
+JOIN sales_reps s ON d.sales_rep_id = s.sales_rep_id
+{where}ORDER BY d.dealer_id;
+"""
+
+
+def _find_entity(user_query, cache):
+    """(original value, its terms) of the longest cached entity named in the query, or (None, set())"""
+    query = f" {normalize_text(user_query)} "
+    best = None
+    for normalized, original in cache.items():
+        if normalized and f" {normalized} " in query and (best is None or len(normalized) > len(best[0])):
+            best = (normalized, original)
+    if best is None:
+        return None, set()
+    return best[1], set(tokenize(best[1]))
+
+
+def _find_product_name(user_query):
+    name, terms = _find_entity(user_query, rag.PRODUCT_NAME_CACHE)
+    if name is not None:
+        return name, terms
+    # Typos: fuzzy match the words after "to" / "like" / "as"
+    tail = re.search(r"\b(?:to|like|as|than|for)\s+(.+?)\s*\??$", user_query, re.IGNORECASE)
+    if tail:
+        match, _ = fuzzy_match_string(tail.group(1), list(rag.PRODUCT_NAME_CACHE.values()), threshold=85)
+        if match:
+            return match, set(tokenize(tail.group(1)))
+    return None, set()
+
+
+def _leftover(user_query, template, slot_terms=()):
+    """Query terms that are neither template vocabulary nor part of a resolved slot"""
+    allowed = TEMPLATE_VOCABULARY[template] | set(slot_terms)
+    return [term for term in tokenize(user_query) if term not in allowed and not term.isdigit()]
+
+
+def _order_limit(user_query):
+    """Number of orders asked for, or None when it is more than TEMPLATE_3 returns"""
+    match = re.search(r"\b(\d+)\b", user_query)
+    if match:
+        limit = int(match.group(1))
+        return max(1, limit) if limit <= MAX_ORDER_ROWS else None
+    for word, value in NUMBER_WORDS.items():
+        if re.search(rf"\b{word}\b", user_query, re.IGNORECASE):
+            return value
+    return 3
+
+
+def _render(name, sql, params):
+    print(f"DEBUG: SQL template {name} matched, skipping SQL generation")
+    return {"template": name, "sql": sql.strip(), "params": tuple(params)}
+
+
+@timing.timed("sql_template")
+def match_template(user_query, user=None):
+    """
+    {"template", "sql", "params"} when the question is one of TEMPLATE_1-4 for this user,
+    else None. Role scoping follows get_llm_sql's access rules.
+    """
+    user = user or rag.get_current_user()
+    if not user_query or user is None:
+        return None
+    ensure_entity_caches()
+
+    # TEMPLATE_3: recent orders, scoped to the dealer's / sales rep's own orders
+    if ORDERS_PATTERN.search(user_query) and not _leftover(user_query, "TEMPLATE_3"):
+        if user.is_dealer() and user.dealer_id:
+            where, params = "WHERE o.dealer_id = %s\n", [user.dealer_id]
+        elif user.is_sales_rep() and user.sales_rep_id:
+            where, params = "WHERE o.sales_rep_id = %s\n", [user.sales_rep_id]
+        elif user.is_admin():
+            where, params = "", []
+        else:
+            return None
+        limit = _order_limit(user_query)
+        if limit is None:
+            print(f"DEBUG: More than {MAX_ORDER_ROWS} orders requested, not using TEMPLATE_3")
+            return None
+        return _render("TEMPLATE_3", TEMPLATE_3_SQL.format(where=where), params + [limit])
+
+    # TEMPLATE_4: sales rep per dealer; a dealer only sees their own assignment
+    if SALES_REP_PATTERN.search(user_query) and not _leftover(user_query, "TEMPLATE_4"):
+        if user.is_dealer() and user.dealer_id:
+            if not MY_PATTERN.search(user_query) and not EACH_DEALER_PATTERN.search(user_query):
+                return None
+            return _render("TEMPLATE_4", TEMPLATE_4_SQL.format(where="WHERE d.dealer_id = %s\n"), [user.dealer_id])
+        if EACH_DEALER_PATTERN.search(user_query):
+            if user.is_sales_rep() and user.sales_rep_id:
+                return _render("TEMPLATE_4", TEMPLATE_4_SQL.format(where="WHERE d.sales_rep_id = %s\n"),
+                               [user.sales_rep_id])
+            if user.is_admin():
+                return _render("TEMPLATE_4", TEMPLATE_4_SQL.format(where=""), [])
+        return None
+
+    # TEMPLATE_2: similar products (inventory and product data are open to every role)
+    if SIMILAR_PATTERN.search(user_query):
+        product_name, slot_terms = _find_product_name(user_query)
+        if product_name and not _leftover(user_query, "TEMPLATE_2", slot_terms):
+            return _render("TEMPLATE_2", TEMPLATE_2_SQL, [product_name, product_name])
+        return None
+
+    # TEMPLATE_1: stock in all warehouses, optionally for one product
+    if STOCK_PATTERN.search(user_query):
+        product_id, slot_terms = _find_entity(user_query, rag.PRODUCT_CACHE)
+        column = "p.product_id"
+        if product_id is None:
+            product_id, slot_terms = _find_entity(user_query, rag.PRODUCT_NAME_CACHE)
+            column = "p.product_name"
+        if _leftover(user_query, "TEMPLATE_1", slot_terms):
+            return None
+        if product_id is not None:
+            return _render("TEMPLATE_1", TEMPLATE_1_SQL.format(where=f"WHERE {column} = %s\n"), [product_id])
+        if ALL_WAREHOUSES_PATTERN.search(user_query):
+            return _render("TEMPLATE_1", TEMPLATE_1_SQL.format(where=""), [])
+    return None
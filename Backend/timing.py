@@ -0,0 +1,186 @@
+import time
+import bisect
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# === Per-stage latency instrumentation ===
+# Pipeline stages (user lookup, intent, SQL generation / execution, rewrite, embedding,
+# metadata, vector search, final answer) run inside timing.stage(name) or @timed(name).
+# Each stage records wall time plus the payload sizes and Azure `usage` tokens of the
+# LLM calls made inside it (llm_client reports those). Every stage feeds process-wide
+# histograms (GET /internal/metrics); during an /api/query request the stages are also
+# collected per request and returned in a Server-Timing header (ServerTimingMiddleware).
+# Stages started in worker threads (asyncio.to_thread copies the context) land in the same
+# request.
+
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_request = contextvars.ContextVar("request_timing", default=None)
+_stage = contextvars.ContextVar("timing_stage", default=None)
+_histograms = {}   # stage -> histogram dict
+_histogram_lock = threading.Lock()
+
+
+class StageRecord:
+    __slots__ = ("name", "start", "duration_ms", "counts")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.counts = {}   # bytes_out / bytes_in / prompt_tokens / completion_tokens / llm_calls
+
+
+class RequestTiming:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.stages.append(record)
+
+    def summary(self):
+        """Finished stages merged by name, in order of first start"""
+        merged = {}
+        with self.lock:
+            stages = [record for record in self.stages if record.duration_ms is not None]
+        for record in sorted(stages, key=lambda r: r.start):
+            entry = merged.setdefault(record.name, {"ms": 0.0, "count": 0})
+            entry["ms"] += record.duration_ms
+            entry["count"] += 1
+            for key, value in record.counts.items():
+                entry[key] = entry.get(key, 0) + value
+        for entry in merged.values():
+            entry["ms"] = round(entry["ms"], 1)
+        return merged
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def header(self):
+        """Server-Timing value: one metric per stage (dur in ms, desc with sizes / tokens) plus total"""
+        parts = []
+        for name, entry in self.summary().items():
+            details = [f"{key}={entry[key]}" for key in ("count", "prompt_tokens", "completion_tokens", "bytes_out", "bytes_in")
+                       if entry.get(key)]
+            desc = f';desc="{" ".join(details)}"' if details else ""
+            parts.append(f"{name};dur={entry['ms']}{desc}")
+        parts.append(f"total;dur={self.total_ms()}")
+        return ", ".join(parts)
+
+
+def _observe(name, duration_ms, counts):
+    with _histogram_lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(BUCKETS_MS) + 1), "totals": {}}
+            _histograms[name] = histogram
+        histogram["count"] += 1
+        histogram["sum_ms"] += duration_ms
+        histogram["max_ms"] = max(histogram["max_ms"], duration_ms)
+        histogram["buckets"][bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+        for key, value in counts.items():
+            histogram["totals"][key] = histogram["totals"].get(key, 0) + value
+
+
+@contextmanager
+def stage(name):
+    record = StageRecord(name)
+    request = _request.get()
+    if request is not None:
+        request.add(record)
+    token = _stage.set(record)
+    try:
+        yield record
+    finally:
+        _stage.reset(token)
+        record.duration_ms = (time.perf_counter() - record.start) * 1000
+        _observe(name, record.duration_ms, record.counts)
+
+
+def timed(name):
+    """Run a function (sync or async) as a stage"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(**counts):
+    """Add counts (payload bytes, tokens, ...) to the innermost running stage"""
+    record = _stage.get()
+    if record is None:
+        return
+    for key, value in counts.items():
+        if value:
+            record.counts[key] = record.counts.get(key, 0) + value
+
+
+def record_usage(usage):
+    """Token counts from an Azure OpenAI `usage` object"""
+    if isinstance(usage, dict):
+        add(prompt_tokens=usage.get("prompt_tokens") or 0, completion_tokens=usage.get("completion_tokens") or 0)
+
+
+def current_summary():
+    request = _request.get()
+    if request is None:
+        return None
+    return {"stages": request.summary(), "total_ms": request.total_ms()}
+
+
+def histograms():
+    """Per-stage latency histograms (bucket upper bounds in ms; the last bucket is open)"""
+    with _histogram_lock:
+        snapshot = {name: {**h, "buckets": list(h["buckets"]), "totals": dict(h["totals"])} for name, h in _histograms.items()}
+    for histogram in snapshot.values():
+        histogram["mean_ms"] = round(histogram["sum_ms"] / histogram["count"], 1) if histogram["count"] else 0.0
+        histogram["sum_ms"] = round(histogram["sum_ms"], 1)
+        histogram["max_ms"] = round(histogram["max_ms"], 1)
+        histogram["buckets"] = dict(zip([f"le_{b}" for b in BUCKETS_MS] + ["le_inf"], histogram["buckets"]))
+    return snapshot
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware: per-request stage collection and a Server-Timing header for the given paths"""
+
+    def __init__(self, app, paths=("/api/query",)):
+        self.app = app
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+        request = RequestTiming()
+        token = _request.set(request)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                # Streamed responses start early, so their header only covers the stages finished by then;
+                # /api/query/stream also reports the full breakdown in its `done` event
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", request.header().encode("latin-1", "replace")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request.reset(token)
+            _observe("request_total", request.total_ms(), {})
@@ -0,0 +1,1110 @@
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+import numpy as np
+from fuzzywuzzy import fuzz
+from lexical_index import LexicalIndex, tokenize
+
+# === In-process vector index over vector_store ===
+# The table is streamed in once (paged, scoring columns only) and kept as a contiguous float32 matrix of
+# L2-normalised embeddings, so a chat query only costs one matrix-vector product
+# instead of a full-table fetch plus a JSON decode per row.
+
+
+def parse_embedding(value):
+    """Turn a vector_store embedding (pgvector text or list) into a float32 array"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def parse_metadata(value):
+    """vector_store.metadata is stored as JSON text by the ingestion scripts"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except Exception:
+            return {}
+    return value if isinstance(value, dict) else {}
+
+
+def normalize_rows(matrix):
+    """L2-normalise each row in place; zero vectors stay zero so they score 0"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+# Columns held per indexed row. Descriptions are long and only needed for the final
+# top-k, so they are dropped here and fetched on demand (see fetch_descriptions).
+LAZY_COLUMNS = ("embedding", "description")
+
+
+def _index_row(row):
+    return {k: v for k, v in row.items() if k not in LAZY_COLUMNS}
+
+
+def _row_vector(row):
+    """Parse a row's embedding, returning None when it cannot be used"""
+    try:
+        vector = parse_embedding(row["embedding"])
+    except Exception:
+        return None
+    if vector.ndim != 1 or vector.size == 0:
+        return None
+    return vector
+
+
+# === Inverted metadata index ===
+# Fields the metadata extractor can return; each maps normalised values to row positions
+INDEXED_METADATA_FIELDS = (
+    "dealer_id", "dealer_name", "sales_rep_id", "sales_rep_name",
+    "product_id", "product_name", "category",
+    "warehouse_id", "warehouse_location", "claim_id", "order_id",
+)
+
+
+def normalize_metadata_value(value):
+    """Looser key used for near-exact hits: '100/35R24 50P' and '10035r24 50p' collide"""
+    return re.sub(r'[^a-z0-9]', '', str(value).lower())
+
+
+def metadata_value_score(filter_value, filter_key, value_key, value_is_str):
+    """Same scoring rules as rag.enhanced_metadata_filter_matching, applied to one distinct value"""
+    if filter_key == value_key:
+        return 1.0
+    if isinstance(filter_value, str) and value_is_str:
+        similarity = fuzz.ratio(filter_key, value_key)
+        return similarity / 100 if similarity >= 70 else 0.0
+    if filter_key in value_key or value_key in filter_key:
+        return 0.7
+    return 0.0
+
+
+class MetadataIndex:
+    def __init__(self):
+        self.postings = {field: {} for field in INDEXED_METADATA_FIELDS}    # field -> lowered value -> [positions]
+        self.normalized = {field: {} for field in INDEXED_METADATA_FIELDS}  # field -> normalised value -> {lowered values}
+        self.string_values = {field: set() for field in INDEXED_METADATA_FIELDS}
+        # Role shards: the dealer_id / sales_rep_id postings, plus rows owned by neither
+        # (product and inventory data) that every role may read
+        self.shared = []
+        # Sub-index per vector_store.table_join (product, claim+..., inventory+..., orders...)
+        self.tables = {}
+
+    def add(self, pos, meta, table_join=None, live=False):
+        """
+        Index one slot. live=True when searches may be reading this index (VectorIndex.upsert):
+        a value seen for the first time goes into a copy of the field's dicts that is then
+        swapped in, so a reader iterating a vocabulary never sees it change size. Posting
+        lists are append-only and are always safe to read.
+        """
+        for field in INDEXED_METADATA_FIELDS:
+            value = meta.get(field)
+            if not value:
+                continue
+            key = str(value).lower()
+            postings = self.postings[field]
+            if key in postings:
+                postings[key].append(pos)
+            elif live:
+                self.postings[field] = {**postings, key: [pos]}
+            else:
+                postings[key] = [pos]
+            # After the postings: a reader that finds the key here can already look it up there
+            normalized_key = normalize_metadata_value(value)
+            normalized = self.normalized[field]
+            if live and key not in normalized.get(normalized_key, ()):
+                self.normalized[field] = {**normalized, normalized_key: normalized.get(normalized_key, set()) | {key}}
+            elif not live:
+                normalized.setdefault(normalized_key, set()).add(key)
+            if isinstance(value, str):
+                self.string_values[field].add(key)
+        if not meta.get("dealer_id") and not meta.get("sales_rep_id"):
+            self.shared.append(pos)
+        if table_join:
+            self.tables.setdefault(table_join, []).append(pos)
+
+    def table_positions(self, count, table_joins):
+        """Positions (< count) belonging to any of the given table_join sub-indexes"""
+        tables = [np.asarray(self.tables[t], dtype=np.int64) for t in table_joins if t in self.tables]
+        if not tables:
+            return np.empty(0, dtype=np.int64)
+        positions = np.concatenate(tables)
+        return positions[positions < count]
+
+    def match_values(self, field, filter_value):
+        """
+        Distinct values of a field matching the filter value, with their scores.
+        Exact and near-exact hits are dictionary lookups; only when neither exists
+        is the field's vocabulary scanned with the fuzzy rules.
+        """
+        vocabulary = self.postings.get(field)
+        if not vocabulary:
+            return []
+        filter_key = str(filter_value).lower()
+        if filter_key in vocabulary:
+            return [(filter_key, 1.0)]
+        near = self.normalized[field].get(normalize_metadata_value(filter_value), ())
+        keys = near if near else vocabulary.keys()
+        matches = []
+        for key in keys:
+            score = metadata_value_score(filter_value, filter_key, key, key in self.string_values[field])
+            if score > 0:
+                matches.append((key, score))
+        return matches
+
+    def scope(self, count, dealer_id=None, sales_rep_id=None):
+        """Positions (< count) in the shared shard plus the given dealer's or sales rep's shard"""
+        shards = [self.shared]
+        if dealer_id is not None:
+            shards.append(self.postings["dealer_id"].get(str(dealer_id).lower(), []))
+        if sales_rep_id is not None:
+            shards.append(self.postings["sales_rep_id"].get(str(sales_rep_id).lower(), []))
+        positions = np.unique(np.concatenate([np.asarray(shard, dtype=np.int64) for shard in shards]))
+        return positions[positions < count]
+
+    def candidates(self, metadata_filter, count, min_score=0.3):
+        """
+        Positions (< count) whose metadata matches the filter with an average score of at least min_score.
+        Keys outside INDEXED_METADATA_FIELDS score 0 but still count towards the average,
+        as they did in the per-row matcher.
+        """
+        scores = np.zeros(count, dtype=np.float32)
+        for field, filter_value in metadata_filter.items():
+            if not filter_value:
+                continue
+            for key, score in self.match_values(field, filter_value):
+                positions = np.asarray(self.postings[field][key], dtype=np.int64)
+                scores[positions[positions < count]] += score
+        scores /= len(metadata_filter)
+        return np.flatnonzero(scores >= min_score)
+
+
+# === Approximate search: IVF (inverted file over k-means partitions) ===
+# Off by default. With VECTOR_INDEX_ANN=ivf and at least VECTOR_INDEX_ANN_MIN_ROWS rows,
+# unfiltered searches only score the rows in the `nprobe` partitions whose centroids are
+# closest to the query. Raise nprobe for recall, lower it for latency; measure with
+# `python vector_index.py eval-recall`.
+ANN_MODE = os.getenv("VECTOR_INDEX_ANN", "exact").lower()
+ANN_MIN_ROWS = int(os.getenv("VECTOR_INDEX_ANN_MIN_ROWS", "20000"))
+ANN_NLIST = int(os.getenv("VECTOR_INDEX_NLIST", "0"))   # 0 -> about 4 * sqrt(rows)
+ANN_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+
+
+def train_centroids(vectors, nlist, n_iter=20, seed=0):
+    """Spherical k-means over normalised vectors; returns normalised centroids"""
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=nlist)
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            # Re-seed dead partitions so nlist stays meaningful
+            sums[empty] = vectors[rng.choice(len(vectors), empty.size, replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFPartitions:
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.lists = [[] for _ in range(len(centroids))]
+
+    @property
+    def nlist(self):
+        return len(self.lists)
+
+    def assign(self, positions, vectors, batch_size=8192):
+        for start in range(0, len(positions), batch_size):
+            chunk = vectors[start:start + batch_size]
+            for pos, partition in zip(positions[start:start + batch_size], np.argmax(chunk @ self.centroids.T, axis=1)):
+                self.lists[partition].append(int(pos))
+
+    def add(self, pos, vector):
+        self.lists[int(np.argmax(self.centroids @ vector))].append(pos)
+
+    def probe(self, query, nprobe):
+        """Positions in the nprobe partitions closest to the (normalised) query"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        closest = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        lists = [np.asarray(self.lists[i], dtype=np.int64) for i in closest if self.lists[i]]
+        return np.concatenate(lists) if lists else np.empty(0, dtype=np.int64)
+
+
+# === Quantized storage ===
+# VECTOR_INDEX_QUANTIZATION=float16|int8 keeps only compact codes of the base segment in
+# RAM. A first pass scores the codes, then the best top_k * VECTOR_INDEX_RESCORE_FACTOR
+# candidates are rescored exactly against float32 vectors. Those are read from a
+# memory-mapped file (the snapshot, or a spill file), so only rescored rows get paged in.
+QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "none").lower()
+RESCORE_FACTOR = int(os.getenv("VECTOR_INDEX_RESCORE_FACTOR", "4"))
+QUANTIZE_BLOCK_ROWS = 16384   # rows per block when encoding
+SCORE_BLOCK_BYTES = 1 << 19   # float32 scratch per block when scoring codes (fits in L2)
+BATCH_SCORE_BYTES = 1 << 26   # float32 score matrix per block of queries in search_batch
+
+# === Hybrid retrieval ===
+# With VECTOR_INDEX_LEXICAL on (default), descriptions are tokenized into a BM25 index
+# while loading and searches given the query text fuse both rankings.
+LEXICAL_SEARCH = os.getenv("VECTOR_INDEX_LEXICAL", "true").lower() == "true"
+RRF_K = 60           # reciprocal rank fusion constant
+HYBRID_DEPTH = 50    # candidates taken from each ranking before fusing
+
+
+class QuantizedMatrix:
+    def __init__(self, matrix, kind):
+        self.kind = kind
+        self.scale = None
+        if kind == "float16":
+            self.codes = np.empty(matrix.shape, dtype=np.float16)
+        elif kind == "int8":
+            # Per-dimension symmetric scale: each column uses the full int8 range
+            self.scale = np.zeros(matrix.shape[1], dtype=np.float32)
+            for start in range(0, matrix.shape[0], QUANTIZE_BLOCK_ROWS):
+                np.maximum(self.scale, np.abs(matrix[start:start + QUANTIZE_BLOCK_ROWS]).max(axis=0), out=self.scale)
+            self.scale /= 127
+            self.scale[self.scale == 0] = 1.0
+            self.codes = np.empty(matrix.shape, dtype=np.int8)
+        else:
+            raise ValueError(f"Unknown vector index quantization: {kind}")
+        for start in range(0, matrix.shape[0], QUANTIZE_BLOCK_ROWS):
+            block = matrix[start:start + QUANTIZE_BLOCK_ROWS]
+            self.codes[start:start + QUANTIZE_BLOCK_ROWS] = block if self.scale is None else np.round(block / self.scale)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def scores(self, query, rows=None):
+        """Approximate scores; codes are widened block by block to keep temporaries cache-sized"""
+        if self.scale is not None:
+            query = query * (self.scale[:, None] if query.ndim == 2 else self.scale)
+        codes = self.codes if rows is None else self.codes[rows]
+        out = np.empty((codes.shape[0],) + query.shape[1:], dtype=np.float32)
+        block = max(64, SCORE_BLOCK_BYTES // (4 * codes.shape[1]))
+        scratch = np.empty((min(block, codes.shape[0]), codes.shape[1]), dtype=np.float32)
+        for start in range(0, codes.shape[0], block):
+            chunk = codes[start:start + block]
+            widened = scratch[:chunk.shape[0]]
+            widened[...] = chunk
+            out[start:start + chunk.shape[0]] = widened @ query
+        return out
+
+
+def spill_to_memmap(matrix, directory=None):
+    """Move a float32 matrix out of the heap into a read-only memory-mapped file"""
+    if isinstance(matrix, np.memmap) or matrix.shape[0] == 0:
+        return matrix
+    with tempfile.NamedTemporaryFile(prefix="vector_index_", suffix=".npy", dir=directory, delete=False) as f:
+        np.save(f, matrix)
+        path = f.name
+    mapped = np.load(path, mmap_mode="r")
+    try:
+        os.unlink(path)  # the mapping keeps the data alive
+    except OSError:
+        pass
+    return mapped
+
+
+def prepare_base(matrix):
+    """Quantize the base segment when configured; returns (base, quantized or None)"""
+    if QUANTIZATION in ("", "none") or matrix.shape[0] == 0:
+        return matrix, None
+    quantized = QuantizedMatrix(matrix, QUANTIZATION)
+    base = spill_to_memmap(matrix, SNAPSHOT_DIR)
+    print(f"DEBUG: Quantized {matrix.shape[0]} vectors to {QUANTIZATION} ({matrix.nbytes // 1024} KiB -> {quantized.nbytes // 1024} KiB resident)")
+    return base, quantized
+
+
+class IndexView:
+    """
+    Consistent read-only view of the index taken under its lock.
+    Vectors live in two segments: a read-only base (possibly a memmapped snapshot shared
+    between workers) and an in-RAM tail that incremental upserts append to.
+    """
+    def __init__(self, base, tail, ids, alive, rows, metadata_index, ivf=None, quantized=None, lexical=None):
+        self.base = base
+        self.tail = tail
+        self.ids = ids
+        self.alive = alive
+        self.rows = rows
+        self.metadata_index = metadata_index
+        self.ivf = ivf
+        self.quantized = quantized
+        self.lexical = lexical
+        self.base_count = base.shape[0]
+        self.count = alive.shape[0]
+
+    @property
+    def dim(self):
+        return self.base.shape[1] if self.base_count else self.tail.shape[1]
+
+    def scores(self, query, candidates=None):
+        """query is (dim,) or (dim, n_queries); returns scores for all slots or the given ones"""
+        if candidates is None:
+            parts = [self.base @ query] if self.base_count else []
+            if self.tail.shape[0]:
+                parts.append(self.tail @ query)
+            return np.concatenate(parts) if len(parts) > 1 else parts[0]
+        in_base = candidates < self.base_count
+        if in_base.all():
+            return self.base[candidates] @ query
+        out = np.empty((candidates.size,) + query.shape[1:], dtype=np.float32)
+        out[in_base] = self.base[candidates[in_base]] @ query
+        out[~in_base] = self.tail[candidates[~in_base] - self.base_count] @ query
+        return out
+
+    def approx_scores(self, query, candidates=None):
+        """Like scores(), but the base segment is scored from its quantized codes"""
+        if self.quantized is None:
+            return self.scores(query, candidates)
+        if candidates is None:
+            parts = [self.quantized.scores(query)] if self.base_count else []
+            if self.tail.shape[0]:
+                parts.append(self.tail @ query)
+            return np.concatenate(parts) if len(parts) > 1 else parts[0]
+        in_base = candidates < self.base_count
+        out = np.empty((candidates.size,) + query.shape[1:], dtype=np.float32)
+        out[in_base] = self.quantized.scores(query, candidates[in_base])
+        out[~in_base] = self.tail[candidates[~in_base] - self.base_count] @ query
+        return out
+
+    def vectors(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        in_base = positions < self.base_count
+        out = np.empty((positions.size, self.dim), dtype=np.float32)
+        out[in_base] = self.base[positions[in_base]]
+        out[~in_base] = self.tail[positions[~in_base] - self.base_count]
+        return out
+
+
+class VectorIndex:
+    def __init__(self):
+        self.base = np.empty((0, 0), dtype=np.float32)   # read-only segment
+        self.tail = np.empty((0, 0), dtype=np.float32)   # over-allocated append segment
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.rows = []       # vector_store rows without the embedding / description columns
+        self.metadata = []   # parsed metadata, parallel to rows
+        self.metadata_index = MetadataIndex()
+        self.ivf = None        # IVFPartitions when approximate search is enabled
+        self.quantized = None  # QuantizedMatrix of the base segment when quantization is enabled
+        self.lexical = LexicalIndex() if LEXICAL_SEARCH else None   # BM25 over descriptions
+        self.loaded = False
+        self.version = 0     # bumped on every build / upsert / remove
+        self._count = 0      # used slots across both segments
+        self._positions = {}  # vector_store id -> live slot
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self._positions)
+
+    @property
+    def dim(self):
+        return self.base.shape[1] if self.base.shape[0] else self.tail.shape[1]
+
+    @property
+    def watermark(self):
+        """Highest vector_store id held, used to replay rows added after a snapshot"""
+        return int(self.ids[:self._count].max()) if self._count else 0
+
+    def view(self):
+        with self._lock:
+            return self._view_unlocked()
+
+    def _view_unlocked(self):
+        count = self._count
+        base_count = self.base.shape[0]
+        return IndexView(self.base, self.tail[:count - base_count], self.ids[:count], self.alive[:count],
+                         self.rows, self.metadata_index, self.ivf, self.quantized, self.lexical)
+
+    def install(self, matrix, ids, rows, metadata=None, lexical=None):
+        """Swap in a fully built base segment (normalised float32, may be a read-only memmap)"""
+        if lexical is None and LEXICAL_SEARCH:
+            lexical = LexicalIndex(len(ids))
+        if metadata is None:
+            metadata = [parse_metadata(row.get("metadata")) for row in rows]
+        metadata_index = MetadataIndex()
+        for pos, meta in enumerate(metadata):
+            metadata_index.add(pos, meta, rows[pos].get("table_join"))
+        ids = np.array(ids, dtype=np.int64)
+        matrix, quantized = prepare_base(matrix)
+
+        with self._lock:
+            self.base = matrix
+            self.quantized = quantized
+            self.tail = np.empty((0, matrix.shape[1]), dtype=np.float32)
+            self.ids = ids
+            self.alive = np.ones(len(ids), dtype=bool)
+            self.rows = list(rows)
+            self.metadata = list(metadata)
+            self.metadata_index = metadata_index
+            self.lexical = lexical
+            self._count = len(ids)
+            self._positions = {int(row_id): pos for pos, row_id in enumerate(ids)}
+            self.ivf = None
+            self.loaded = True
+            self.version += 1
+        print(f"DEBUG: Vector index built with {len(rows)} rows (dim={self.dim}, version={self.version})")
+        if ANN_MODE == "ivf" and len(ids) >= ANN_MIN_ROWS:
+            self.build_ann()
+
+    def build_ann(self, nlist=None, n_iter=20, sample_per_list=256):
+        """Train IVF partitions on the live vectors and switch unfiltered search to them"""
+        view = self.view()
+        live = np.flatnonzero(view.alive)
+        if live.size == 0:
+            return None
+        nlist = nlist or ANN_NLIST or int(4 * np.sqrt(live.size))
+        rng = np.random.default_rng(0)
+        sample = live if live.size <= nlist * sample_per_list else rng.choice(live, nlist * sample_per_list, replace=False)
+        started = time.perf_counter()
+        ivf = IVFPartitions(train_centroids(view.vectors(sample), nlist, n_iter=n_iter))
+        for start in range(0, live.size, 65536):
+            chunk = live[start:start + 65536]
+            ivf.assign(chunk, view.vectors(chunk))
+
+        with self._lock:
+            if self.rows is not view.rows:
+                # Compacted or rebuilt while training: positions no longer line up
+                print("DEBUG: Vector index changed during IVF training, skipping swap")
+                return None
+            # Rows upserted while training
+            late = np.flatnonzero(self.alive[view.count:self._count]) + view.count
+            if late.size:
+                ivf.assign(late, self._view_unlocked().vectors(late))
+            self.ivf = ivf
+        print(f"DEBUG: IVF built with {ivf.nlist} partitions over {live.size} rows in {time.perf_counter() - started:.2f}s")
+        return ivf
+
+    def build(self, rows):
+        """
+        Replace the index contents with the given vector_store rows.
+        `rows` may be any iterable (e.g. iter_vector_store_rows): vectors are written
+        straight into a growing float32 matrix, so only the current page of raw rows
+        is held at a time.
+        """
+        matrix = None
+        kept_rows, kept_meta, ids = [], [], []
+        lexical = LexicalIndex() if LEXICAL_SEARCH else None
+        for row in rows:
+            vector = _row_vector(row)
+            if vector is None:
+                continue
+            if matrix is None:
+                matrix = np.empty((1024, vector.size), dtype=np.float32)
+            elif vector.size != matrix.shape[1]:
+                print(f"DEBUG: Skipping vector_store row {row.get('id')} with dim {vector.size} (expected {matrix.shape[1]})")
+                continue
+            if len(ids) == matrix.shape[0]:
+                grown = np.empty((matrix.shape[0] * 2, matrix.shape[1]), dtype=np.float32)
+                grown[:len(ids)] = matrix
+                matrix = grown
+            matrix[len(ids)] = vector
+            if lexical is not None:
+                lexical.add(len(ids), tokenize(row.get("description")))
+            kept_rows.append(_index_row(row))
+            kept_meta.append(parse_metadata(row.get("metadata")))
+            ids.append(row.get("id", -1))
+
+        if matrix is None:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        matrix = normalize_rows(np.ascontiguousarray(matrix[:len(ids)]))
+        self.install(matrix, ids, kept_rows, kept_meta, lexical)
+
+    # --- incremental updates (fed by the pg_notify listeners) ---
+
+    def _grow(self, needed):
+        """Make room for `needed` slots; only the tail and the per-slot arrays grow"""
+        base_count = self.base.shape[0]
+        tail_needed = needed - base_count
+        if tail_needed > self.tail.shape[0]:
+            tail = np.zeros((max(tail_needed, self.tail.shape[0] * 2, 64), self.dim), dtype=np.float32)
+            tail[:self._count - base_count] = self.tail[:self._count - base_count]
+            self.tail = tail
+        if needed > self.ids.shape[0]:
+            capacity = max(needed, self.ids.shape[0] * 2, 64)
+            ids = np.full(capacity, -1, dtype=np.int64)
+            ids[:self._count] = self.ids[:self._count]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self._count] = self.alive[:self._count]
+            self.ids, self.alive = ids, alive
+
+    def _tombstone(self, row_id):
+        pos = self._positions.pop(row_id, None)
+        if pos is not None:
+            self.alive[pos] = False
+        return pos
+
+    def _maybe_compact(self):
+        """Fold both segments into a fresh base once tombstones make up a quarter of the slots"""
+        dead = self._count - len(self._positions)
+        if dead < max(256, self._count // 4):
+            return
+        keep = np.flatnonzero(self.alive[:self._count])
+        base_count = self.base.shape[0]
+        self.base, self.quantized = prepare_base(np.ascontiguousarray(np.vstack([
+            self.base[keep[keep < base_count]],
+            self.tail[keep[keep >= base_count] - base_count],
+        ])))
+        self.tail = np.empty((0, self.base.shape[1]), dtype=np.float32)
+        self.ids = self.ids[keep]
+        self.alive = np.ones(keep.size, dtype=bool)
+        self.rows = [self.rows[i] for i in keep]
+        self.metadata = [self.metadata[i] for i in keep]
+        self.metadata_index = MetadataIndex()
+        for pos, meta in enumerate(self.metadata):
+            self.metadata_index.add(pos, meta, self.rows[pos].get("table_join"))
+        if self.lexical is not None:
+            self.lexical = self.lexical.compacted(keep)
+        self._count = int(keep.size)
+        self._positions = {int(row_id): pos for pos, row_id in enumerate(self.ids)}
+        if self.ivf is not None:
+            ivf = IVFPartitions(self.ivf.centroids)
+            ivf.assign(np.arange(self._count), self.base)
+            self.ivf = ivf
+        print(f"DEBUG: Vector index compacted, dropped {dead} tombstones")
+
+    def upsert(self, row):
+        """
+        Append a vector_store row, or replace the live entry with the same id.
+        A replaced entry is tombstoned and the new version appended to the tail, so
+        readers holding an older view never see a half-written vector and a memmapped
+        base is never written to.
+        """
+        if row.get("id") is None:
+            print("DEBUG: Vector index upsert skipped: row has no id")
+            return False
+        vector = _row_vector(row)
+        if vector is None:
+            print(f"DEBUG: Vector index upsert skipped: row {row.get('id')} has no usable embedding")
+            return False
+        row_id = int(row["id"])
+
+        with self._lock:
+            if self._count and vector.size != self.dim:
+                print(f"DEBUG: Vector index upsert skipped: row {row_id} has dim {vector.size} (expected {self.dim})")
+                return False
+            if not self._count:
+                self.base = np.empty((0, vector.size), dtype=np.float32)
+                self.tail = np.empty((0, vector.size), dtype=np.float32)
+            self._tombstone(row_id)
+            self._grow(self._count + 1)
+
+            pos = self._count
+            norm = np.linalg.norm(vector)
+            vector = vector / norm if norm else vector
+            self.tail[pos - self.base.shape[0]] = vector
+            if self.ivf is not None:
+                self.ivf.add(pos, vector)
+            self.ids[pos] = row_id
+            self.alive[pos] = True
+            self.rows.append(_index_row(row))
+            self.metadata.append(parse_metadata(row.get("metadata")))
+            self.metadata_index.add(pos, self.metadata[pos], row.get("table_join"), live=True)
+            if self.lexical is not None:
+                self.lexical.add(pos, tokenize(row.get("description")), live=True)
+            self._positions[row_id] = pos
+            self._count += 1
+            self._maybe_compact()
+            self.version += 1
+        return True
+
+    def remove(self, row_id):
+        """Tombstone the entry for a vector_store id"""
+        with self._lock:
+            if self._tombstone(int(row_id)) is None:
+                return False
+            self._maybe_compact()
+            self.version += 1
+        return True
+
+    def search(self, query_embedding, top_k=10, similarity_threshold=0.1, positions=None,
+               metadata_filter=None, dealer_id=None, sales_rep_id=None, table_joins=None,
+               nprobe=None, exact=False, query_text=None):
+        """
+        Cosine top-k over the live entries, optionally restricted to the given row positions,
+        to rows matching a metadata filter (see MetadataIndex.candidates), to the shared
+        shard plus a dealer's or sales rep's shard (see MetadataIndex.scope) and to the
+        given table_join sub-indexes. With query_text the cosine ranking is fused with a
+        BM25 ranking of the descriptions (see _hybrid_search).
+        Returns (similarity, row) pairs, best first.
+        """
+        if query_text and self.lexical is not None:
+            results, n_above = self._hybrid_search(query_embedding, query_text, top_k, similarity_threshold,
+                                                   positions, metadata_filter, dealer_id, sales_rep_id,
+                                                   table_joins, nprobe, exact)
+        else:
+            results, n_above = self._search(query_embedding, top_k, similarity_threshold, positions,
+                                             metadata_filter, dealer_id, sales_rep_id, table_joins,
+                                             nprobe, exact)
+        if results:
+            print(f"DEBUG: Found {n_above} results above threshold {similarity_threshold}")
+            print(f"DEBUG: Top similarity scores: {[round(sim, 3) for sim, _ in results[:5]]}")
+        return results
+
+    @staticmethod
+    def _filter_positions(view, positions=None, metadata_filter=None, dealer_id=None,
+                          sales_rep_id=None, table_joins=None):
+        """Slots allowed by the given restrictions, or None when nothing restricts the search"""
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.int64)
+        if table_joins:
+            tables = view.metadata_index.table_positions(view.count, table_joins)
+            positions = tables if positions is None else np.intersect1d(tables, positions)
+        if dealer_id is not None or sales_rep_id is not None:
+            scoped = view.metadata_index.scope(view.count, dealer_id, sales_rep_id)
+            positions = scoped if positions is None else np.intersect1d(scoped, positions)
+        if metadata_filter:
+            matched = view.metadata_index.candidates(metadata_filter, view.count)
+            positions = matched if positions is None else np.intersect1d(matched, positions)
+        return positions
+
+    @staticmethod
+    def _top_k(scores, top_k, similarity_threshold):
+        """Indices into scores of the best top_k above the threshold (best first), and how many were above"""
+        above = np.flatnonzero(scores >= similarity_threshold)
+        n_above = int(above.size)
+        if n_above > top_k:
+            best = np.argpartition(-scores[above], top_k - 1)[:top_k]
+            above = above[best]
+        return above[np.argsort(-scores[above], kind="stable")], n_above
+
+    def _search(self, query_embedding, top_k, similarity_threshold, positions=None,
+                metadata_filter=None, dealer_id=None, sales_rep_id=None, table_joins=None,
+                nprobe=None, exact=False):
+        view = self.view()
+        if not view.count or top_k <= 0:
+            return [], 0
+        positions = self._filter_positions(view, positions, metadata_filter, dealer_id, sales_rep_id, table_joins)
+        if positions is not None and positions.size == 0:
+            return [], 0
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        if query.size != view.dim:
+            raise ValueError(f"Query embedding has dim {query.size}, index has dim {view.dim}")
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return [], 0
+        query = query / norm
+
+        if nprobe is None:
+            nprobe = ANN_NPROBE
+        if positions is None and view.ivf is not None and not exact and nprobe > 0:
+            # nprobe=0 scans every partition
+            positions = view.ivf.probe(query, nprobe)
+        if positions is None:
+            candidates = np.flatnonzero(view.alive) if not view.alive.all() else None
+        else:
+            candidates = np.asarray(positions, dtype=np.int64)
+            candidates = candidates[view.alive[candidates]]
+        if candidates is not None and candidates.size == 0:
+            return [], 0
+        if view.quantized is not None and not exact:
+            # First pass on the codes, exact float32 rescoring of the shortlist
+            approx = view.approx_scores(query, candidates)
+            shortlist = top_k * RESCORE_FACTOR
+            if approx.size > shortlist:
+                best = np.argpartition(-approx, shortlist - 1)[:shortlist]
+            else:
+                best = np.arange(approx.size)
+            candidates = best if candidates is None else candidates[best]
+            scores = view.vectors(candidates) @ query
+        else:
+            scores = view.scores(query, candidates)
+
+        above, n_above = self._top_k(scores, top_k, similarity_threshold)
+        results = []
+        for i in above:
+            pos = int(i) if candidates is None else int(candidates[i])
+            results.append((float(scores[i]), view.rows[pos]))
+        return results, n_above
+
+    def _hybrid_search(self, query_embedding, query_text, top_k, similarity_threshold, positions=None,
+                       metadata_filter=None, dealer_id=None, sales_rep_id=None, table_joins=None,
+                       nprobe=None, exact=False):
+        """
+        Reciprocal rank fusion of the cosine and BM25 rankings over the same allowed rows:
+        each row scores sum(1 / (RRF_K + rank)) over the rankings it appears in.
+        Rows only found lexically still report their cosine similarity.
+        """
+        depth = max(top_k * 5, HYBRID_DEPTH)
+        dense, n_above = self._search(query_embedding, depth, similarity_threshold, positions,
+                                      metadata_filter, dealer_id, sales_rep_id, table_joins,
+                                      nprobe, exact)
+        fused = {}   # vector_store id -> [fused score, similarity, row]
+        for rank, (similarity, row) in enumerate(dense):
+            fused[row.get("id")] = [1 / (RRF_K + rank + 1), similarity, row]
+
+        view = self.view()
+        terms = tokenize(query_text)
+        if view.count and terms and view.lexical is not None:
+            lexical_scores = view.lexical.scores(terms, view.count, view.alive)
+            allowed = self._filter_positions(view, positions, metadata_filter, dealer_id, sales_rep_id, table_joins)
+            if allowed is not None:
+                mask = np.zeros(view.count, dtype=bool)
+                mask[allowed] = True
+                lexical_scores[~mask] = 0
+            hits, n_hits = self._top_k(lexical_scores, depth, 1e-6)
+            if n_hits:
+                query = np.asarray(query_embedding, dtype=np.float32).ravel()
+                norm = np.linalg.norm(query)
+                similarities = view.vectors(hits) @ (query / norm if norm else query)
+                for rank, pos in enumerate(hits):
+                    row = view.rows[int(pos)]
+                    entry = fused.get(row.get("id"))
+                    if entry is None:
+                        fused[row.get("id")] = [1 / (RRF_K + rank + 1), float(similarities[rank]), row]
+                    else:
+                        entry[0] += 1 / (RRF_K + rank + 1)
+                print(f"DEBUG: Lexical search matched {n_hits} rows for {len(set(terms))} terms")
+                n_above = max(n_above, len(fused))
+
+        ranked = sorted(fused.values(), key=lambda entry: -entry[0])[:top_k]
+        return [(similarity, row) for _, similarity, row in ranked], n_above
+
+    def identifier_lookup(self, query_text, max_hits=10):
+        """
+        Live rows whose descriptions contain every identifier in the query (ORD0042, CLM0012,
+        100/35R24...), if there are between 1 and max_hits of them; otherwise None.
+        """
+        view = self.view()
+        if view.lexical is None or not view.count:
+            return None
+        matched = view.lexical.identifier_positions(tokenize(query_text), view.count, view.alive)
+        if matched is None or not 0 < matched.size <= max_hits:
+            return None
+        return [view.rows[int(pos)] for pos in matched]
+
+    def search_batch(self, query_embeddings, top_k=10, similarity_threshold=0.1, filters=None):
+        """
+        Exact cosine top-k for several queries at once: the candidate rows are scored with
+        one (rows x dim) @ (dim x queries) product per block of queries instead of a scan
+        per query. `filters` is an optional list with one dict (or None) per query holding
+        search() restrictions: positions, metadata_filter, dealer_id, sales_rep_id, table_joins.
+        Returns one list of (similarity, row) pairs per query, best first.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        n_queries = queries.shape[0]
+        results = [[] for _ in range(n_queries)]
+        view = self.view()
+        if not view.count or top_k <= 0 or n_queries == 0:
+            return results
+        if queries.shape[1] != view.dim:
+            raise ValueError(f"Query embeddings have dim {queries.shape[1]}, index has dim {view.dim}")
+        filters = filters or [None] * n_queries
+        if len(filters) != n_queries:
+            raise ValueError(f"Got {len(filters)} filters for {n_queries} queries")
+        queries = normalize_rows(queries.copy())
+        has_norm = np.linalg.norm(queries, axis=1) > 0
+
+        live = np.flatnonzero(view.alive)
+        slots = []
+        for query_filter in filters:
+            positions = self._filter_positions(view, **(query_filter or {}))
+            slots.append(live if positions is None else positions[view.alive[positions]])
+        active = [j for j in range(n_queries) if has_norm[j] and slots[j].size]
+        if not active:
+            return results
+        union = live if any(slots[j] is live for j in active) else np.unique(np.concatenate([slots[j] for j in active]))
+        # Mostly-full scans read the segments directly; narrow ones gather just the union
+        scored_rows = None if union.size * 2 > view.count else union
+        n_rows = view.count if scored_rows is None else union.size
+        block = max(1, BATCH_SCORE_BYTES // (4 * n_rows))
+
+        for start in range(0, len(active), block):
+            chunk = active[start:start + block]
+            scores = view.scores(np.ascontiguousarray(queries[chunk].T), scored_rows)
+            for col, j in enumerate(chunk):
+                rows_idx = slots[j] if scored_rows is None else np.searchsorted(union, slots[j])
+                query_scores = scores[rows_idx, col]
+                above, _ = self._top_k(query_scores, top_k, similarity_threshold)
+                results[j] = [(float(query_scores[i]), view.rows[int(slots[j][i])]) for i in above]
+        print(f"DEBUG: Batch search scored {len(active)} queries against {n_rows} rows")
+        return results
+
+
+# === On-disk snapshot ===
+# embeddings.npy (normalised float32), ids.npy, rows.jsonl and a manifest holding the
+# id watermark. Snapshots are opened with mmap_mode="r", so every uvicorn worker maps
+# the same file pages instead of each pulling and decoding vector_store. Rows added
+# after the export are replayed from Supabase (id > watermark) on load; in-place
+# updates are picked up by the listeners or by re-exporting.
+SNAPSHOT_DIR = os.getenv("VECTOR_INDEX_SNAPSHOT_DIR")
+SNAPSHOT_FORMAT = 1
+
+
+def _replace_file(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def export_snapshot(index, directory):
+    """Write the live entries of the index to `directory`"""
+    view = index.view()
+    live = np.flatnonzero(view.alive)
+    matrix = view.vectors(live) if live.size else np.empty((0, view.dim if view.count else 0), dtype=np.float32)
+    ids = view.ids[live]
+    watermark = int(ids.max()) if ids.size else 0
+
+    os.makedirs(directory, exist_ok=True)
+    _replace_file(os.path.join(directory, "embeddings.npy"), lambda f: np.save(f, matrix))
+    _replace_file(os.path.join(directory, "ids.npy"), lambda f: np.save(f, ids))
+    _replace_file(os.path.join(directory, "rows.jsonl"), lambda f: f.writelines(
+        (json.dumps(view.rows[pos], default=str) + "\n").encode("utf-8") for pos in live
+    ))
+    if view.lexical is not None:
+        lexical = view.lexical.compacted(live)
+        _replace_file(os.path.join(directory, "lexical.json"), lambda f: f.write(json.dumps(lexical.to_dict()).encode("utf-8")))
+    manifest = {"format": SNAPSHOT_FORMAT, "count": int(ids.size), "dim": int(matrix.shape[1]), "watermark": watermark}
+    # Manifest goes last: a reader never sees it pointing at half-written arrays
+    _replace_file(os.path.join(directory, "manifest.json"), lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+    print(f"DEBUG: Vector index snapshot written to {directory} ({ids.size} rows, watermark={watermark})")
+    return manifest
+
+
+def load_snapshot(index, directory):
+    """Install a snapshot into the index (embeddings memory-mapped); returns its manifest"""
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported vector index snapshot format: {manifest.get('format')}")
+    matrix = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+    ids = np.load(os.path.join(directory, "ids.npy"))
+    with open(os.path.join(directory, "rows.jsonl"), encoding="utf-8") as f:
+        rows = [_index_row(json.loads(line)) for line in f if line.strip()]
+    if not (matrix.shape[0] == ids.size == len(rows) == manifest["count"]):
+        raise ValueError(f"Vector index snapshot in {directory} is inconsistent")
+    lexical = None
+    lexical_path = os.path.join(directory, "lexical.json")
+    if LEXICAL_SEARCH and os.path.exists(lexical_path):
+        with open(lexical_path, encoding="utf-8") as f:
+            lexical = LexicalIndex.from_dict(json.load(f))
+        if lexical.size != ids.size:
+            raise ValueError(f"Vector index snapshot in {directory} is inconsistent")
+    elif LEXICAL_SEARCH:
+        print(f"DEBUG: Snapshot in {directory} has no lexical index; BM25 only covers rows added later")
+    index.install(matrix, ids, rows, lexical=lexical)
+    return manifest
+
+
+def replay_delta(index, client, watermark):
+    """Upsert vector_store rows added after the given id watermark"""
+    replayed = 0
+    for row in iter_vector_store_rows(client, after_id=watermark):
+        index.upsert(row)
+        replayed += 1
+    print(f"DEBUG: Replayed {replayed} vector_store rows after watermark {watermark}")
+    return replayed
+
+
+# === Paged loading ===
+# PostgREST caps every response at its max-rows setting, so a single select("*") silently
+# truncates large stores. Rows are paged by id (keyset, not offset) and only the
+# columns needed for scoring and filtering are transferred (plus descriptions for the
+# BM25 index when it is on; they are tokenized per page and not kept).
+SCORING_COLUMNS = "id, embedding, table_join, metadata" + (", description" if LEXICAL_SEARCH else "")
+PAGE_SIZE = int(os.getenv("VECTOR_INDEX_PAGE_SIZE", "1000"))
+
+
+def iter_vector_store_rows(client, after_id=0, columns=SCORING_COLUMNS, page_size=PAGE_SIZE):
+    """Yield vector_store rows with id > after_id in id order, one page at a time"""
+    last_id = after_id
+    pages = 0
+    while True:
+        response = (client.table("vector_store").select(columns)
+                    .gt("id", last_id).order("id").limit(page_size).execute())
+        page = response.data or []
+        # Stop on an empty page rather than a short one: the server's max-rows may be
+        # lower than page_size
+        if not page:
+            break
+        pages += 1
+        last_id = page[-1]["id"]
+        yield from page
+    print(f"DEBUG: Streamed vector_store in {pages} pages (last id {last_id})")
+
+
+def fetch_descriptions(client, rows):
+    """
+    Return copies of the given index rows with their description filled in, fetched
+    in one request. The shared index rows are left without descriptions.
+    """
+    missing = [row["id"] for row in rows if "description" not in row and row.get("id") is not None]
+    descriptions = {}
+    if missing:
+        try:
+            response = client.table("vector_store").select("id, description").in_("id", missing).execute()
+            descriptions = {item["id"]: item.get("description") for item in response.data or []}
+        except Exception as e:
+            print(f"DEBUG: Could not fetch vector_store descriptions: {e}")
+    return [row if "description" in row else {**row, "description": descriptions.get(row.get("id"), "")}
+            for row in rows]
+
+
+VECTOR_INDEX = VectorIndex()
+_load_lock = threading.Lock()
+
+# === Freshness ===
+# Rows written to vector_store by other processes (the standalone listeners, the
+# Embedding-DB scripts) reach the index without any listener in this process: at most
+# every VECTOR_INDEX_REFRESH seconds a query kicks off a background replay of the rows
+# above the index's id watermark. In-place updates and deletes need the vector_store
+# change listener (index_listener.py, on by default) or a reload.
+REFRESH_INTERVAL = float(os.getenv("VECTOR_INDEX_REFRESH", "30"))   # seconds, 0 disables
+_refresh_lock = threading.Lock()
+_last_refresh = 0.0
+
+
+def _replay_in_background(client):
+    try:
+        replay_delta(VECTOR_INDEX, client, VECTOR_INDEX.watermark)
+    except Exception as e:
+        print(f"DEBUG: Vector index refresh failed: {e}")
+    finally:
+        _refresh_lock.release()
+
+
+def refresh_vector_index(client):
+    """Start a delta replay if the last one is older than REFRESH_INTERVAL; never blocks the caller"""
+    global _last_refresh
+    if REFRESH_INTERVAL <= 0 or not VECTOR_INDEX.loaded or time.monotonic() - _last_refresh < REFRESH_INTERVAL:
+        return False
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    _last_refresh = time.monotonic()
+    threading.Thread(target=_replay_in_background, args=(client,), name="vector-index-refresh", daemon=True).start()
+    return True
+
+
+def _fetch_and_build(client):
+    global _last_refresh
+    _last_refresh = time.monotonic()
+    if SNAPSHOT_DIR and os.path.exists(os.path.join(SNAPSHOT_DIR, "manifest.json")):
+        try:
+            manifest = load_snapshot(VECTOR_INDEX, SNAPSHOT_DIR)
+            replay_delta(VECTOR_INDEX, client, manifest["watermark"])
+            return
+        except Exception as e:
+            print(f"DEBUG: Could not load vector index snapshot from {SNAPSHOT_DIR}: {e}")
+    VECTOR_INDEX.build(iter_vector_store_rows(client))
+
+
+def load_vector_index(client):
+    """(Re)build the shared index from the snapshot if configured, otherwise from vector_store"""
+    with _load_lock:
+        _fetch_and_build(client)
+    return VECTOR_INDEX
+
+
+def get_vector_index(client):
+    """Return the shared index, loading it on first use and refreshing it periodically"""
+    if not VECTOR_INDEX.loaded:
+        with _load_lock:
+            if not VECTOR_INDEX.loaded:
+                _fetch_and_build(client)
+    else:
+        refresh_vector_index(client)
+    return VECTOR_INDEX
+
+
+def apply_vector_store_upsert(row):
+    """
+    Mirror a vector_store insert/update into the live index.
+    Nothing to do until the index has been loaded; the first load will pick the row up.
+    """
+    if not VECTOR_INDEX.loaded:
+        return False
+    if VECTOR_INDEX.upsert(row):
+        print(f"DEBUG: Vector index updated with row {row.get('id')} (version={VECTOR_INDEX.version})")
+        return True
+    return False
+
+
+def apply_vector_store_delete(row_id):
+    """Mirror a vector_store delete into the live index"""
+    if not VECTOR_INDEX.loaded:
+        return False
+    return VECTOR_INDEX.remove(row_id)
+
+
+def evaluate_ann_recall(index, n_queries=200, k=10, nprobes=(1, 2, 4, 8, 16, 32), noise=0.05, seed=0):
+    """
+    Recall@k and per-query latency of the approximate modes (IVF and/or quantization) against
+    exact search. Queries are stored vectors with gaussian noise, so each one has a realistic
+    neighbourhood in the index.
+    """
+    if index.ivf is None and index.quantized is None:
+        raise ValueError("Nothing to evaluate: enable quantization or build IVF partitions (VectorIndex.build_ann)")
+    view = index.view()
+    live = np.flatnonzero(view.alive)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(live, min(n_queries, live.size), replace=False)
+    queries = view.vectors(picks)
+    queries = normalize_rows(queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32))
+
+    def run(**kwargs):
+        ids, latencies = [], []
+        for query in queries:
+            started = time.perf_counter()
+            results, _ = index._search(query, k, float("-inf"), **kwargs)
+            latencies.append((time.perf_counter() - started) * 1000)
+            ids.append({row.get("id") for _, row in results})
+        return ids, np.asarray(latencies)
+
+    exact_ids, exact_ms = run(exact=True)
+    report = [{"mode": "exact", "recall": 1.0, "p50_ms": float(np.percentile(exact_ms, 50)), "p99_ms": float(np.percentile(exact_ms, 99))}]
+    modes = [(f"ivf nprobe={nprobe}", nprobe) for nprobe in nprobes] if index.ivf is not None else []
+    if index.quantized is not None:
+        modes.insert(0, (index.quantized.kind, 0))
+    for mode, nprobe in modes:
+        ann_ids, ann_ms = run(nprobe=nprobe)
+        recall = np.mean([len(a & e) / max(1, len(e)) for a, e in zip(ann_ids, exact_ids)])
+        report.append({"mode": mode, "recall": float(recall),
+                       "p50_ms": float(np.percentile(ann_ms, 50)), "p99_ms": float(np.percentile(ann_ms, 99))})
+    return report
+
+
+# === Entry point ===
+# python vector_index.py export [directory]  -> snapshot vector_store for the API workers
+# python vector_index.py eval-recall         -> IVF recall/latency vs exact search
+if __name__ == "__main__":
+    import argparse
+    from supabase_client import supabase
+
+    parser = argparse.ArgumentParser(description="Manage the in-process vector_store index")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export", help="Write an on-disk snapshot of vector_store")
+    export_parser.add_argument("directory", nargs="?", default=SNAPSHOT_DIR)
+    eval_parser = subcommands.add_parser("eval-recall", help="Compare IVF search against exact search")
+    eval_parser.add_argument("--queries", type=int, default=200)
+    eval_parser.add_argument("--k", type=int, default=10)
+    eval_parser.add_argument("--nlist", type=int, default=0)
+    eval_parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="Comma-separated nprobe values")
+    eval_parser.add_argument("--no-ivf", action="store_true", help="Only evaluate quantization")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        if not args.directory:
+            parser.error("Pass a directory or set VECTOR_INDEX_SNAPSHOT_DIR")
+        VECTOR_INDEX.build(iter_vector_store_rows(supabase))
+        export_snapshot(VECTOR_INDEX, args.directory)
+
+    elif args.command == "eval-recall":
+        index = get_vector_index(supabase)
+        if not args.no_ivf:
+            index.build_ann(nlist=args.nlist or None)
+        nprobes = [int(n) for n in args.nprobe.split(",") if n.strip()]
+        print(f"{'mode':<18}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for line in evaluate_ann_recall(index, args.queries, args.k, nprobes):
+            print(f"{line['mode']:<18}{line['recall']:>10.3f}{line['p50_ms']:>10.2f}{line['p99_ms']:>10.2f}")
@@ -1,11 +1,12 @@
 import os
 import json
-import time
 import asyncio
 import asyncpg
-import requests
+import llm_client
+import embedding_cache
 from dotenv import load_dotenv
 from supabase_client import supabase
+from index_listener import notify_vector_store_change
 from pathlib import Path
 import ssl
 
@@ -35,18 +36,25 @@ def preprocess_order_row(row):
 
 
 # === 🤖 Call Azure to get embedding ===
-def get_embedding_with_retry(payload, max_retries=5):
+async def get_embedding_with_retry(payload, max_retries=5):
     delay = 3
     if endpoint is None:
         raise ValueError("AZURE_EMBEDDING_URL environment variable is not set.")
+    text = embedding_cache.payload_text(payload)
+    cached = embedding_cache.lookup(text)
+    if cached is not None:
+        return cached
+
     for attempt in range(max_retries):
-        response = requests.post(str(endpoint), headers=headers, json=payload)
+        response = await llm_client.apost(endpoint, headers=headers, json=payload)
         if response.status_code == 200:
-            return response.json()["data"][0]["embedding"]
+            embedding = response.json()["data"][0]["embedding"]
+            embedding_cache.store(text, embedding)
+            return embedding
         elif response.status_code == 429:
             wait_time = delay * (2 ** attempt)
             print(f"⚠️ Rate limit hit. Retrying in {wait_time}s...")
-            time.sleep(wait_time)
+            await asyncio.sleep(wait_time)
         else:
             raise Exception(f"Embedding failed: {response.status_code} - {response.text}")
     raise Exception("❌ Max retries exceeded.")
@@ -63,10 +71,10 @@ async def handle_new_order(conn, pid, channel, payload):
         payload = {"input": [description]}
 
         # Get embedding
-        embedding = get_embedding_with_retry(payload)
+        embedding = await get_embedding_with_retry(payload)
 
         # Insert into vector_store
-        supabase.table("vector_store").insert({
+        result = supabase.table("vector_store").insert({
             "description": description,
             "embedding": embedding,
             "table_join": f"orders",
@@ -82,6 +90,10 @@ async def handle_new_order(conn, pid, channel, payload):
             })
         }).execute()
 
+        # API workers mirror the new row into their vector index (index_listener.py)
+        for row in result.data or []:
+            await notify_vector_store_change(conn, row["id"], row.get("table_join", "orders"))
+
         print(f"✅ Order {order_id} embedded and stored successfully.")
     except Exception as e:
         print(f"❌ Error processing new order: {e}")
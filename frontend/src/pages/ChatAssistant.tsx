@@ -180,28 +180,62 @@ const ChatAssistant = () => {
     setSelectedContext(null);
     try {
       const username = localStorage.getItem("username");
-      const response = await fetch(`${API_URL}/api/query`, {
+      // Server-sent events: `delta` chunks of the answer as it is generated, then `done`
+      // (same body as /api/query) or `error`.
+      const response = await fetch(`${API_URL}/api/query/stream`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ username, query: userMessage.content }),
       });
-      const result = await response.json();
-      const assistantMessage: Message = {
-        id: (Date.now() + 1).toString(),
-        content: result.success ? result.answer : "Sorry, I can't assist with that.",
-        sender: 'assistant',
-        timestamp: new Date()
-      };
-      setChats(prev => prev.map(chat =>
-        chat.id === currentChatId
-          ? {
+      if (!response.ok || !response.body) throw new Error(`Query failed: ${response.status}`);
+      const assistantId = (Date.now() + 1).toString();
+      const showAssistant = (content: string) => {
+        const assistantMessage: Message = { id: assistantId, content, sender: 'assistant', timestamp: new Date() };
+        setChats(prev => prev.map(chat => {
+          if (chat.id !== currentChatId) return chat;
+          const shown = chat.messages.some(m => m.id === assistantId);
+          return {
             ...chat,
-            messages: [...chat.messages, assistantMessage],
-            lastMessage: assistantMessage.content.substring(0, 50) + "...",
+            messages: shown
+              ? chat.messages.map(m => m.id === assistantId ? assistantMessage : m)
+              : [...chat.messages, assistantMessage],
+            lastMessage: content.substring(0, 50) + "...",
             title: userMessage.content.substring(0, 30) + "..."
+          };
+        }));
+      };
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let streamed = "";
+      let result: { success?: boolean; answer?: string } | null = null;
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary = buffer.indexOf("\n\n");
+        while (boundary !== -1) {
+          const rawEvent = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          boundary = buffer.indexOf("\n\n");
+          let event = "message";
+          let data = "";
+          for (const line of rawEvent.split("\n")) {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) data += line.slice(5).trim();
           }
-          : chat
-      ));
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (event === "delta") {
+            streamed += payload.text;
+            setIsTyping(false);
+            showAssistant(streamed);
+          } else if (event === "done" || event === "error") {
+            result = payload;
+          }
+        }
+      }
+      showAssistant(result?.success ? (result.answer ?? streamed) : "Sorry, I can't assist with that.");
     } catch (error) {
       const assistantMessage: Message = {
         id: (Date.now() + 1).toString(),